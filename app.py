@@ -1,29 +1,66 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from flask import Flask, Request, render_template, make_response, send_from_directory, request, redirect, url_for, session, jsonify, flash, g
 from flask_sqlalchemy import SQLAlchemy
+from flask.json.provider import DefaultJSONProvider
+from flask_session import Session
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.orm import joinedload, backref
-from functools import wraps
+from werkzeug.security import check_password_hash, safe_join
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from sqlalchemy.orm import joinedload, selectinload, backref, load_only, aliased
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from jinja2 import FileSystemBytecodeCache
+from functools import wraps, lru_cache
 import firebase_admin
 from firebase_admin import credentials, auth
 import os
 import json # <<< CRITICAL IMPORT FOR JSON.LOADS
 import secrets
-from datetime import datetime, timedelta
+import hashlib
+import tempfile
+import shutil
+import mimetypes
+from types import MappingProxyType, SimpleNamespace
+from collections import defaultdict
+from datetime import datetime, timedelta, date
 import math
 import razorpay
 import decimal 
 from twilio.rest import Client
 import logging
+import sqlite3
 import random
 import requests
+import redis
+import msgpack
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv # <<< CRITICAL NEW IMPORT
-from sqlalchemy import inspect # <<< CRITICAL IMPORT FOR DB CHECK
+from sqlalchemy import inspect, text, select, insert, update, bindparam, exists, or_, and_, func, case, cast, Numeric, Integer, JSON, Date # <<< CRITICAL IMPORT FOR DB CHECK
 
 # Load environment variables from .env file (must be at the top)
 load_dotenv() # <<< CRITICAL NEW FUNCTION CALL
 
 # === CUSTOM JINJA FILTER ===
+@lru_cache(maxsize=4096)
+def _strptime_cached(value, format_string):
+    """Memoized strptime: listing pages repeat the same date strings row after row."""
+    return datetime.strptime(value, format_string)
+
+def _strptime(value, format_string):
+    try:
+        return _strptime_cached(value, format_string)
+    except TypeError:
+        # Unhashable input (shouldn't happen from templates) - parse without the cache
+        return datetime.strptime(value, format_string)
+
 def datetime_format(value, format_string):
     """Converts a date string (e.g., YYYY-MM-DDTHH:MM or YYYY-MM-DD HH:MM) to a datetime object."""
     if not value: return None
@@ -34,10 +71,10 @@ def datetime_format(value, format_string):
         format_string = '%Y-%m-%d %H:%M'
         
     try:
-        return datetime.strptime(value, format_string)
+        return _strptime(value, format_string)
     except ValueError as e:
         try:
-            return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+            return _strptime(value, '%Y-%m-%d %H:%M:%S')
         except ValueError:
             print(f"Error parsing date/time '{value}' with format '{format_string}'. Error: {e}")
             return None
@@ -46,12 +83,37 @@ def datetime_format(value, format_string):
 # NEW FILTER: To safely extract the date part in templates
 def split_date(value):
     """Splits a date-time string (YYYY-MM-DD HH:MM) and returns only the date part."""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
     if value and ' ' in value:
         return value.split(' ')[0]
     return value
     
+# === JSON PROVIDER ===
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    jsonify()/request.get_json() backed by orjson. Types orjson can't encode natively (Decimal, Markup...)
+    still go through Flask's default handler. Formatting kwargs (indent, sort_keys...) are ignored.
+    """
+    options = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # jsonify(): hand orjson's bytes straight to the response (no decode to str and re-encode)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.options | orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype
+        )
+
 # === CONFIGURATION ===
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ---------------------------------------------------------------------
 # CRITICAL CHANGE: PostgreSQL Configuration using Environment Variables
@@ -60,35 +122,136 @@ app = Flask(__name__)
 DATABASE_URL = os.environ.get('DATABASE_URL', None)
 
 if DATABASE_URL:
-    if DATABASE_URL.startswith("postgres://"):
-        DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+    # Use the psycopg (v3, binary) driver: postgres:// and postgresql:// both map to postgresql+psycopg://
+    for legacy_scheme in ("postgres://", "postgresql://"):
+        if DATABASE_URL.startswith(legacy_scheme):
+            DATABASE_URL = DATABASE_URL.replace(legacy_scheme, "postgresql+psycopg://", 1)
+            break
         
     app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True, # Drop connections the server closed while idle instead of failing a request
+        'pool_recycle': 1800,
+        'query_cache_size': 1200, # room for every distinct statement the app issues (default 500)
+    }
     print("Using PostgreSQL from Environment Variable.")
 else:
     # WARNING: To apply schema changes (like removing columns),  
     # DELETE the 'project_data.db' file before running the app again.
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(app.root_path, 'project_data.db') 
     print("WARNING: DATABASE_URL not found. Using SQLite for local development.")
-    
-app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', secrets.token_hex(32))
+
+    # WAL + synchronous=NORMAL: a commit appends to the write-ahead log instead of fsyncing the
+    # rollback journal and the database file, and readers no longer block the writer
+    @event.listens_for(Engine, 'connect')
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA temp_store=MEMORY')
+            cursor.close()
+    
+# `or` so the random fallback is only generated when the env var is missing
+app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY') or secrets.token_hex(32)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # File Upload Configuration
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'pdf'} # Added PDF for documents
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'webp', 'pdf'}) # Added PDF for documents
 UPLOAD_FOLDER = os.path.join(app.root_path, 'static', 'uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# KYC documents live outside static/ and are only reachable through the login-protected /kyc/ route
+KYC_FOLDER = os.environ.get('KYC_FOLDER') or os.path.join(app.instance_path, 'kyc')
+app.config['KYC_FOLDER'] = KYC_FOLDER
+os.makedirs(KYC_FOLDER, exist_ok=True)
+# Let the front web server do the file transfer: behind nginx set KYC_ACCEL_REDIRECT_PREFIX to an
+# `internal` location aliased to KYC_FOLDER; behind Apache (mod_xsendfile) set USE_X_SENDFILE=1.
+app.config['KYC_ACCEL_REDIRECT_PREFIX'] = os.environ.get('KYC_ACCEL_REDIRECT_PREFIX')
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+# Reject oversized bodies before they are read (KYC PDFs / vehicle photos)
+app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+UPLOAD_SPOOL_SIZE = 1024 * 1024
+
+class UploadRequest(Request):
+    """
+    Keeps small uploads in RAM; bodies past 1 MB are written straight to a named temp file inside
+    UPLOAD_FOLDER, so save_upload() can hard-link it into place instead of copying the bytes.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length > UPLOAD_SPOOL_SIZE:
+            return tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER, prefix='.upload-')
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE, dir=UPLOAD_FOLDER)
+
+app.request_class = UploadRequest
+
+def save_upload(file_storage, save_path):
+    """
+    Moves an uploaded file to save_path: a hard link for disk-backed uploads, else a chunked copy into a
+    temp file that is renamed into place. Either way save_path never exists half-written.
+    """
+    stream = file_storage.stream
+    temp_path = getattr(stream, 'name', None)
+    if isinstance(temp_path, str):
+        try:
+            stream.flush()
+            os.link(temp_path, save_path) # same filesystem: no bytes copied; the temp name is removed on close
+            return
+        except OSError:
+            stream.seek(0)
+    fd, part_path = tempfile.mkstemp(dir=os.path.dirname(save_path), prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(stream, out, UPLOAD_CHUNK_SIZE)
+        os.replace(part_path, save_path)
+    except BaseException:
+        discard_upload(part_path)
+        raise
+
+def discard_upload(path):
+    """Best-effort removal of a file written for a request that then failed."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Upload Cleanup Error ({path}): {e}")
+
+# Deleting replaced files is fire-and-forget; one thread is plenty
+_cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cleanup')
+
+def discard_upload_later(path):
+    """Removes a no-longer-referenced upload off the request thread."""
+    _cleanup_executor.submit(discard_upload, path)
 
 # === RAZORPAY CONFIGURATION (UPDATED WITH PLACEHOLDERS) ===
 app.config['RZP_KEY_ID'] = os.environ.get('RZP_KEY_ID', 'rzp_test_DUMMYID')
 app.config['RZP_KEY_SECRET'] = os.environ.get('RZP_KEY_SECRET', 'DUMMYSECRET')
-app.config['RZP_CLIENT'] = razorpay.Client(auth=(app.config['RZP_KEY_ID'], app.config['RZP_KEY_SECRET']))
+_rzp_client = None
+
+def rzp_client():
+    """Lazily builds one Razorpay client per process (keeps its HTTP session alive across requests)."""
+    global _rzp_client
+    if _rzp_client is None:
+        _rzp_client = razorpay.Client(auth=(app.config['RZP_KEY_ID'], app.config['RZP_KEY_SECRET']))
+    return _rzp_client
 
 # === TWILIO CONFIGURATION (UPDATED WITH PLACEHOLDERS) ===
 app.config['TWILIO_ACCOUNT_SID'] = os.environ.get('TWILIO_ACCOUNT_SID', 'YOUR_TWILIO_ACCOUNT_SID')
 app.config['TWILIO_AUTH_TOKEN'] = os.environ.get('TWILIO_AUTH_TOKEN', 'YOUR_TWILIO_AUTH_TOKEN')
 app.config['TWILIO_PHONE_NUMBER'] = os.environ.get('TWILIO_PHONE_NUMBER', '+15005550006') # Standard Twilio test number as placeholder
+_twilio_client = None
+
+def twilio_client():
+    """Lazily builds one Twilio client per process instead of one per SMS."""
+    global _twilio_client
+    if _twilio_client is None:
+        _twilio_client = Client(app.config['TWILIO_ACCOUNT_SID'], app.config['TWILIO_AUTH_TOKEN'])
+    return _twilio_client
 # ==================================
 
 # === GOOGLE MAPS CONFIGURATION (UPDATED WITH PLACEHOLDERS) ===
@@ -96,6 +259,63 @@ app.config['TWILIO_PHONE_NUMBER'] = os.environ.get('TWILIO_PHONE_NUMBER', '+1500
 app.config['GOOGLE_MAPS_API_KEY'] = os.environ.get('GOOGLE_MAPS_API_KEY', 'AIzaSyDUMMYKEY')
 # ============================================
 
+# === REDIS CONFIGURATION (OPTIONAL SHARED CACHE) ===
+# Without REDIS_URL every cache helper below is a no-op and callers fall through to the database,
+# and sessions stay in Flask's signed cookie.
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = None
+if REDIS_URL:
+    redis_client = redis.Redis(connection_pool=redis.ConnectionPool.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5))
+    # Server-side sessions: the cookie carries only a random session id, the payload lives in Redis.
+    # Each request slides the Redis TTL forward, so idle sessions expire on their own.
+    app.config.update(
+        SESSION_TYPE='redis',
+        SESSION_REDIS=redis_client,
+        SESSION_PERMANENT=False,
+        SESSION_KEY_PREFIX='primedrew:session:',
+        PERMANENT_SESSION_LIFETIME=timedelta(hours=12),
+    )
+    Session(app)
+    print("✅ Redis cache and server-side sessions configured.")
+
+def cache_get(key):
+    """Returns the raw cached bytes, or None on a miss. Redis errors fail open (treated as a miss)."""
+    if redis_client is None:
+        return None
+    try:
+        return redis_client.get(key)
+    except redis.RedisError as e:
+        print(f"Redis GET Error ({key}): {e}")
+        return None
+
+def cache_set(key, value, ttl):
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(key, ttl, value)
+    except redis.RedisError as e:
+        print(f"Redis SET Error ({key}): {e}")
+
+def cache_delete(*keys):
+    if redis_client is None or not keys:
+        return
+    try:
+        redis_client.delete(*keys)
+    except redis.RedisError as e:
+        print(f"Redis DELETE Error ({keys}): {e}")
+
+# Login lookups: a narrow user record cached under the identifier the user types in
+AUTH_CACHE_TTL = 120 # seconds
+AUTH_FIELDS = ('id', 'password', 'role', 'is_active', 'is_approved_host', 'first_name', 'email', 'phone')
+
+def user_cache_key(field, value):
+    return f"primedrew:user:{field}:{value}"
+
+def invalidate_user_cache(phone=None, email=None):
+    """Must be called after any write to a cached AUTH_FIELDS column (password, role, status flags...)."""
+    cache_delete(*[user_cache_key(field, value) for field, value in (('phone', phone), ('email', email)) if value])
+# ===================================================
+
 # NEW: Sub-city data structure
 SUB_CITY_MAP = {
     'Pune': ['Akurdi', 'Pimpri Chinchwad', 'Hinjewadi', 'Shivaji Nagar', 'Pune City', 'Kothrud', 'Wakad'],
@@ -113,16 +333,100 @@ CITY_GEOLOCATION = {
     'Hyderabad': {'lat': 17.3850, 'lng': 78.4867},
     'Delhi': {'lat': 28.7041, 'lng': 77.1025}
 }
+
+SUB_CITY_MAP_JSON = orjson.dumps(SUB_CITY_MAP).decode() # static, so serialized once
+
+def write_sub_city_map_asset():
+    """
+    Publishes SUB_CITY_MAP as static/js/sub_city_map.<hash>.js (window.SUB_CITY_MAP = {...}) so browsers
+    and the CDN cache it once instead of it being inlined in every page. Returns the static filename.
+    """
+    digest = hashlib.sha1(SUB_CITY_MAP_JSON.encode()).hexdigest()[:12]
+    filename = f"js/sub_city_map.{digest}.js"
+    path = os.path.join(app.static_folder, filename)
+    if not os.path.exists(path):
+        asset_dir = os.path.dirname(path)
+        os.makedirs(asset_dir, exist_ok=True)
+        # Write-then-rename so a worker starting concurrently never serves a half-written file
+        fd, tmp_path = tempfile.mkstemp(dir=asset_dir, prefix='.sub_city_map-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(f"window.SUB_CITY_MAP = {SUB_CITY_MAP_JSON};\n")
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    return filename
+
+SUB_CITY_MAP_ASSET = write_sub_city_map_asset()
+
+# Read-only lookup views keyed by lower-cased city name, built once at import.
+_CITY_GEO = MappingProxyType({city.lower(): (loc['lat'], loc['lng']) for city, loc in CITY_GEOLOCATION.items()})
+_SUB_CITIES = MappingProxyType({city.lower(): frozenset(subs) for city, subs in SUB_CITY_MAP.items()}) # O(1) membership checks
+DEFAULT_GEO = (20.5937, 78.9629) # Geographic centre of India
 # ----------------------------------------
 
 def allowed_file(filename):
     if not filename: return False
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    # splitext avoids building a list per call; [1:] drops the leading dot
+    return os.path.splitext(filename)[1][1:].lower() in ALLOWED_EXTENSIONS
+
+# === PASSWORD HASHING ===
+# Argon2id at these parameters verifies in tens of ms, versus hundreds for Werkzeug's default KDF.
+# Tune them per host via env; stored hashes made with other parameters are re-hashed on the next login
+# (verify_password flags them), so old rows never keep costing more than the current setting.
+# Local dev/CI can trade strength for speed (e.g. ARGON2_TIME_COST=1 ARGON2_MEMORY_COST=8192), which also
+# covers the startup admin seed; production keeps the defaults below.
+app.config['ARGON2_TIME_COST'] = int(os.environ.get('ARGON2_TIME_COST', 2))
+app.config['ARGON2_MEMORY_COST'] = int(os.environ.get('ARGON2_MEMORY_COST', 19456)) # KiB
+_password_hasher = PasswordHasher(
+    time_cost=app.config['ARGON2_TIME_COST'], memory_cost=app.config['ARGON2_MEMORY_COST'], parallelism=1
+)
+
+# Hashing runs on a small shared pool: Argon2 releases the GIL, so request threads just wait on it,
+# while concurrent hashes stay capped at the core count (each one also holds ~19 MB of memory)
+_hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix='pwhash')
+
+def hash_password(password):
+    return _hash_executor.submit(_password_hasher.hash, password).result()
+
+# Verified against when a login ID matches no user, so that path costs the same as a real verify
+DUMMY_PASSWORD_HASH = hash_password(secrets.token_urlsafe(16))
+
+def verify_password(stored_hash, password):
+    """
+    Returns (is_valid, needs_rehash).
+    Legacy Werkzeug hashes (pbkdf2:/scrypt:) still verify, and are flagged so the caller can upgrade them to Argon2.
+    """
+    return _hash_executor.submit(_verify_password, stored_hash, password).result()
+
+def _verify_password(stored_hash, password):
+    if stored_hash.startswith('$argon2'):
+        try:
+            _password_hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False, False
+        return True, _password_hasher.check_needs_rehash(stored_hash)
+    return check_password_hash(stored_hash, password), True
+# ========================
 
 db = SQLAlchemy(app)
+
+# Compiled templates are cached on disk so fresh workers skip Jinja's lexer/parser/codegen
+JINJA_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'jinja_cache')
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+if DATABASE_URL:
+    # Production: templates only change on deploy, so skip the per-render mtime check
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    app.jinja_env.auto_reload = False
 # Registering the custom filter
 app.jinja_env.filters['to_datetime'] = datetime_format
 app.jinja_env.filters['split_date'] = split_date
+app.jinja_env.globals['sub_city_map_asset'] = SUB_CITY_MAP_ASSET
+
+# Load the busiest templates at import (after the filters they use are registered) so the first
+# requests on a fresh worker render from the in-memory template cache
+PREWARM_TEMPLATES = ('login.html', 'registration_form.html', 'my_bookings.html', 'receipt_template.html', 'vehicle_search.html')
+for template_name in PREWARM_TEMPLATES:
+    app.jinja_env.get_template(template_name)
 
 # Firebase Admin SDK Initialization (UPDATED FOR RENDER/ENV VARIABLE)
 FIREBASE_PROJECT_ID = 'vehicle-rent-50cc6'
@@ -157,7 +461,7 @@ class User(db.Model):
     password = db.Column(db.String(128), nullable=False)
     first_name = db.Column(db.String(80), nullable=False)
     last_name = db.Column(db.String(80), nullable=False)
-    dob = db.Column(db.String(10), nullable=False)
+    dob = db.Column(db.Date, nullable=False)
     role = db.Column(db.String(50), nullable=False)
     address1 = db.Column(db.String(150), nullable=False)
     address2 = db.Column(db.String(150), nullable=True)
@@ -166,7 +470,7 @@ class User(db.Model):
     pincode = db.Column(db.String(10), nullable=False)
     identity_doc = db.Column(db.String(50), nullable=False)
     dl_number = db.Column(db.String(50), nullable=False)
-    dl_expiry = db.Column(db.String(10), nullable=False)
+    dl_expiry = db.Column(db.Date, nullable=False)
     experience = db.Column(db.Integer, default=0)
     terms_agreed = db.Column(db.Boolean, nullable=False, default=False)
     # NEW: Host Approval Status
@@ -193,7 +497,7 @@ class Vehicle(db.Model):
     type = db.Column(db.String(20), nullable=False)
     fuel = db.Column(db.String(20), nullable=False)
     gear = db.Column(db.String(20), nullable=False)
-    city = db.Column(db.String(50), nullable=False)
+    city = db.Column(db.String(50), nullable=False, index=True) # demand insights filter by city
     sub_city = db.Column(db.String(100), nullable=True)
     # --- NEW: GEOLOCATION FIELDS (NOW PRECISE) ---
     latitude = db.Column(db.Float, nullable=True) 
@@ -201,12 +505,21 @@ class Vehicle(db.Model):
     # ---------------------------------------------
     base_price = db.Column(db.Float, nullable=False)
     rating = db.Column(db.Float, default=4.0)
+    # Running review totals, so a new review updates the average without re-reading the others
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
     image_url = db.Column(db.String(255), nullable=False)
     kms_per_unit = db.Column(db.Integer, default=50)
-    features = db.Column(db.String(255), default="")
+    # Stored as a JSON list so serialization needs no per-row split(',')
+    _features = db.Column('features', db.JSON, default=list)
     # NEW: SPECIFICATION FIELD
     specification = db.Column(db.String(255), nullable=True)
     is_available = db.Column(db.Boolean, nullable=False, default=True)
+
+    # Host fleet lookups (dashboard, profile, block/unblock); host_id alone is served by the prefix
+    __table_args__ = (
+        db.Index('ix_vehicle_host_available', 'host_id', 'is_available'),
+    )
     
     bookings = db.relationship(
         'Booking', 
@@ -216,37 +529,27 @@ class Vehicle(db.Model):
     )
     reviews = db.relationship('Review', backref='vehicle', lazy=True) # NEW Review relationship
 
-    def to_dict(self, booked_dates=[]): 
-        return {
-            'id': self.vehicle_id_code,
-            'db_id': self.id, 
-            'name': self.name,
-            'brand': self.brand,
-            'type': self.type,
-            'fuel': self.fuel,
-            'gear': self.gear,
-            'city': self.city,
-            'sub_city': self.sub_city,
-            # --- NEW EXPORT (PRECISE) ---
-            'lat': self.latitude,
-            'lng': self.longitude,
-            # ----------------------------
-            'base': self.base_price,
-            'rating': self.rating,
-            'img': self.image_url,
-            'features': self.features.split(',') if self.features else [],
-            'kms': self.kms_per_unit,
-            # NEW: EXPORT SPECIFICATION
-            'specification': self.specification,
-            'booked': booked_dates
-        }
+    @hybrid_property
+    def features(self):
+        return self._features or []
+
+    @features.setter
+    def features(self, value):
+        # Accepts a list (form getlist) or a legacy comma-separated string
+        if isinstance(value, str):
+            value = [f for f in value.split(',') if f]
+        self._features = list(value or [])
+
+    @features.expression
+    def features(cls):
+        return cls._features
 
     def __repr__(self): return f'<Vehicle {self.name} in {self.city}>'
 
 
 class Booking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False) 
     start_date = db.Column(db.DateTime, nullable=False) 
     end_date = db.Column(db.DateTime, nullable=False) 
@@ -259,15 +562,81 @@ class Booking(db.Model):
     booked_at = db.Column(db.DateTime, default=datetime.utcnow)
     payment_id = db.Column(db.String(100), nullable=True) 
     refund_status = db.Column(db.String(20), default='NotApplicable') # NotApplicable, Pending, Processed
+    # --- NEW: RECEIPT FIGURES, frozen when the booking is confirmed ---
+    billed_hours = db.Column(db.Float, nullable=True)
+    subtotal_base = db.Column(db.Integer, nullable=True) # pre-tax rental price
+    gst = db.Column(db.Integer, nullable=True)
+    # ------------------------------------------------------------------
+    cancellation_fee = db.Column(db.Integer, nullable=True) # frozen by cancel_booking, read back by the admin refund queue
+
+    # Serves the overlap check in is_vehicle_available (vehicle + status equality, then date range)
+    __table_args__ = (
+        db.Index('ix_booking_vehicle_status_dates', 'vehicle_id', 'status', 'start_date', 'end_date'),
+        # Demand insights: recent confirmed bookings. Partial, so it only holds the rows that query reads
+        db.Index(
+            'ix_booking_confirmed_booked_at', 'booked_at', 'vehicle_id',
+            postgresql_where=text("status = 'Confirmed'"), sqlite_where=text("status = 'Confirmed'")
+        ),
+        # Admin dashboard refund queues
+        db.Index('ix_booking_status_refund', 'status', 'refund_status'),
+        db.Index('ix_booking_deposit_refund', 'status', 'deposit_refund_status', 'end_date'),
+    )
 
     def __repr__(self): return f'<Booking {self.id} for Vehicle {self.vehicle_id}>'
 
+def billed_hours_for(start_date, end_date):
+    """Trips under a day are billed in whole hours; longer ones by the exact duration."""
+    total_hours = (end_date - start_date).total_seconds() / 3600
+    return round(math.ceil(total_hours) if total_hours < 24 else total_hours, 1)
+
+def cancellation_fee_for(total_price, booked_at, cancelled_at):
+    """Free within the first hour after booking, 10% of the total (rounded to the rupee) after that."""
+    if cancelled_at - booked_at < timedelta(hours=1):
+        return 0
+    return round(total_price * 0.10)
+
+def legacy_receipt_figures(start_date, end_date, total_price, deposit_amount):
+    """
+    (billed_hours, subtotal_base, gst) back-computed from the stored total, for bookings made before the
+    figures were saved on the row. GST is approximated from the paid amount minus the deposit.
+    """
+    subtotal = total_price - (deposit_amount or 0)
+    gst = round(subtotal * 0.18)
+    return billed_hours_for(start_date, end_date), round(subtotal - gst), gst
+
+# Plain columns for read-only listings: rows come back as lightweight tuples, with no ORM
+# instance construction or identity-map bookkeeping.
+VEHICLE_LISTING_COLUMNS = (
+    Vehicle.id, Vehicle.vehicle_id_code, Vehicle.name, Vehicle.brand, Vehicle.type,
+    Vehicle.fuel, Vehicle.gear, Vehicle.city, Vehicle.sub_city, Vehicle.latitude,
+    Vehicle.longitude, Vehicle.base_price, Vehicle.rating, Vehicle.image_url,
+    Vehicle.kms_per_unit, Vehicle._features.label('features'), Vehicle.specification,
+)
+# Listing payload keys (the JSON the inventory pages read), position for position with VEHICLE_LISTING_COLUMNS
+VEHICLE_LISTING_KEYS = (
+    'db_id', 'id', 'name', 'brand', 'type',
+    'fuel', 'gear', 'city', 'sub_city', 'lat',
+    'lng', 'base', 'rating', 'img',
+    'kms', 'features', 'specification',
+)
+
+def listing_payload(rows, booked_dates_map):
+    """Listing payload for VEHICLE_LISTING_COLUMNS rows: zips each tuple with the key list, no per-field lookups."""
+    payload = []
+    for row in rows:
+        item = dict(zip(VEHICLE_LISTING_KEYS, row))
+        item['features'] = item['features'] or []
+        item['booked'] = booked_dates_map.get(item['db_id'], [])
+        payload.append(item)
+    return payload
+
+
 # --- NEW REVIEW MODEL ---
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'), unique=True, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # The rider/customer
-    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False)
+    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False, index=True) # Rating aggregation
     rating = db.Column(db.Float, nullable=False)
     comment = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -291,56 +660,390 @@ class Complaint(db.Model):
 
     def __repr__(self):
         return f'<Complaint {self.id} from {self.email}>'
+
+# --- NEW: Precomputed demand aggregate (confirmed bookings per city/type, last 30 days) ---
+class DemandSnapshot(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    city = db.Column(db.String(50), nullable=False)
+    vehicle_type = db.Column(db.String(20), nullable=False)
+    count_30d = db.Column(db.Integer, nullable=False, default=0)
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('city', 'vehicle_type', name='uq_demand_snapshot_city_type'),
+    )
+
+    def __repr__(self):
+        return f'<DemandSnapshot {self.city}/{self.vehicle_type}: {self.count_30d}>'
+
+class DemandSnapshotRefresh(db.Model):
+    """Single row (id=1) recording when the snapshot was last rebuilt, even if the rebuild produced no rows."""
+    id = db.Column(db.Integer, primary_key=True)
+    refreshed_at = db.Column(db.DateTime, nullable=False)
 # ---------------------------------------------
 
 # ==================================
 # === ADMIN CREATION UTILITY (DB-BASED) ===
 # ==================================
 
+# Admin bootstrap messages go through logging (so they reach the server's log pipeline).
+# The logger carries its own INFO handler because gunicorn/Render don't configure the root logger.
+bootstrap_log = logging.getLogger('primedrew.bootstrap')
+if not bootstrap_log.handlers:
+    _bootstrap_handler = logging.StreamHandler()
+    _bootstrap_handler.setFormatter(logging.Formatter('%(message)s'))
+    bootstrap_log.addHandler(_bootstrap_handler)
+    bootstrap_log.setLevel(logging.INFO)
+    bootstrap_log.propagate = False
+
+# Fixed profile for a newly seeded admin, and the flags every admin account is (re)set to
+_ADMIN_DEFAULTS = MappingProxyType({
+    'first_name': "Super",
+    'last_name': "Admin",
+    'dob': date(2000, 1, 1),
+    'address1': "Admin HQ",
+    'address2': None,
+    'city': "Global",
+    'state': "State",
+    'pincode': "000000",
+    'identity_doc': "Aadhar",
+    'dl_number': "ADMN12345",
+    'dl_expiry': date(2030, 1, 1),
+    'terms_agreed': True,
+})
+_ADMIN_FLAGS = MappingProxyType({
+    'role': 'super_admin',
+    'is_approved_host': True,
+    'is_active': True, # Admin must be active
+})
+
+def create_admin_users(admin_specs):
+    """
+    Creates or updates Super Admin users from (email, phone, password) tuples.
+    Runs inside the caller's transaction: the caller commits, so a seed that grows more steps still costs one commit.
+    """
+    # Existing accounts for all requested emails in one query (email is UNIQUE, so these are index lookups),
+    # loading only the columns the up-to-date check and the cache invalidation read
+    emails = [email for email, _, _ in admin_specs]
+    existing = {
+        user.email: user for user in db.session.execute(
+            select(User).options(load_only(
+                User.id, User.email, User.phone, User.password, User.role, User.is_active, User.is_approved_host
+            )).where(User.email.in_(emails))
+        ).scalars()
+    }
+
+    # Already fully set-up admins are candidates for skipping; their passwords are verified in parallel
+    # on the hashing pool (Argon2 releases the GIL, so threads use every core without a process pool)
+    candidates = []
+    for admin_email, _, admin_password in admin_specs:
+        user = existing.get(admin_email)
+        if user and user.role == 'super_admin' and user.is_active and user.is_approved_host and user.password:
+            candidates.append((admin_email, user.password, admin_password))
+    verdicts = _hash_executor.map(
+        _verify_password, [stored for _, stored, _ in candidates], [password for _, _, password in candidates]
+    )
+    up_to_date = set()
+    for (admin_email, _, _), (is_valid, needs_rehash) in zip(candidates, verdicts):
+        # The password matches and isn't due an Argon2 upgrade: nothing to write
+        if is_valid and not needs_rehash:
+            up_to_date.add(admin_email)
+            bootstrap_log.info("✅ Super Admin '%s' already up to date.", admin_email)
+    pending = [spec for spec in admin_specs if spec[0] not in up_to_date]
+    if not pending:
+        return
+
+    # 1. Generate the secure hashes (in parallel on the hashing pool)
+    hashed_passwords = list(_hash_executor.map(_password_hasher.hash, [password for _, _, password in pending]))
+
+    # 2. One multi-row INSERT ... ON CONFLICT (email) DO UPDATE: creates the admins, or promotes/resets the
+    # existing accounts, in a single statement with no window between the check and the write
+    dialect_insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    stmt = dialect_insert(User).values([
+        {
+            'firebase_uid': os.urandom(16).hex(), # Placeholder UID (never used to sign in)
+            'phone': admin_phone,
+            'email': admin_email,
+            'password': hashed_password,
+            **_ADMIN_DEFAULTS,
+            **_ADMIN_FLAGS,
+        }
+        for (admin_email, admin_phone, _), hashed_password in zip(pending, hashed_passwords)
+    ])
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[User.email], set_={'password': stmt.excluded.password, **_ADMIN_FLAGS}
+    ))
+
+    for admin_email, _, _ in pending:
+        user = existing.get(admin_email)
+        if user:
+            invalidate_user_cache(user.phone, user.email)
+            bootstrap_log.info("✅ Existing user '%s' updated to Super Admin with new password.", admin_email)
+        else:
+            bootstrap_log.info("✅ New Super Admin user '%s' created successfully.", admin_email)
+
 def create_admin_user(admin_email, admin_phone, admin_password):
-    """Creates or updates a Super Admin user in the database."""
-    # Check if an admin user with this email already exists
-    user = User.query.filter_by(email=admin_email).first()
-    
-    # 1. Generate the secure hash for the password
-    hashed_password = generate_password_hash(admin_password)
+    """Creates or updates a single Super Admin user (see create_admin_users)."""
+    create_admin_users([(admin_email, admin_phone, admin_password)])
 
-    if user:
-        # Update existing user to be super_admin and set statuses
-        if user.role != 'super_admin':
-            user.role = 'super_admin'
-        user.password = hashed_password
-        user.is_approved_host = True
-        user.is_active = True # Admin must be active
-        db.session.commit()
-        print(f"✅ Existing user '{admin_email}' updated to Super Admin with new password.")
-        
+
+def seed_default_admin():
+    """Creates the default Super Admin, or resets its role, status and password."""
+    bootstrap_log.info("Creating/Updating Super Admin...")
+    create_admin_user("admin@primedrew.com", "9999999999", "adminpass")
+    db.session.commit()
+
+@app.cli.command('seed-admin')
+def seed_admin_command():
+    """Create or reset the default Super Admin (instead of doing it on every `python app.py` start)."""
+    seed_default_admin()
+
+
+# --- NEW: REGISTERED-PHONE SET IN REDIS (answers /api/check-phone-exists without the database) ---
+REGISTERED_PHONES_KEY = 'primedrew:user:phones'
+
+def load_registered_phones():
+    """Rebuilds the Redis set of registered phones; built under a temp key and swapped in atomically."""
+    if redis_client is None:
+        return
+    building_key = f"{REGISTERED_PHONES_KEY}:building:{os.getpid()}"
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.delete(building_key)
+        batch = []
+        for (phone,) in db.session.query(User.phone).yield_per(1000):
+            batch.append(phone)
+            if len(batch) == 1000:
+                pipe.sadd(building_key, *batch)
+                batch = []
+        if batch:
+            pipe.sadd(building_key, *batch)
+        pipe.execute()
+        if redis_client.exists(building_key):
+            redis_client.rename(building_key, REGISTERED_PHONES_KEY)
+        print("✅ Registered phone set loaded into Redis.")
+    except redis.RedisError as e:
+        print(f"⚠️ WARNING: Could not load registered phones into Redis. Error: {e}")
+
+_SADD_IF_EXISTS = "if redis.call('EXISTS', KEYS[1]) == 1 then return redis.call('SADD', KEYS[1], ARGV[1]) end return 0"
+
+def remember_registered_phone(phone):
+    if redis_client is None:
+        return
+    try:
+        # Only add to a fully loaded set: a set created here would hold just this phone and answer "no" for the rest
+        redis_client.eval(_SADD_IF_EXISTS, 1, REGISTERED_PHONES_KEY, phone)
+    except redis.RedisError as e:
+        # The set now misses this phone, so drop it; lookups fall back to the database until the next rebuild
+        print(f"Redis SADD Error ({phone}): {e}")
+        cache_delete(REGISTERED_PHONES_KEY)
+
+def is_registered_phone(phone):
+    """True/False from the Redis set, or None when it can't answer (no Redis, set not loaded, error)."""
+    if redis_client is None:
+        return None
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.exists(REGISTERED_PHONES_KEY)
+        pipe.sismember(REGISTERED_PHONES_KEY, phone)
+        loaded, is_member = pipe.execute()
+    except redis.RedisError as e:
+        print(f"Redis SISMEMBER Error ({phone}): {e}")
+        return None
+    return bool(is_member) if loaded else None
+# ---------------------------------------------------------------------------------------------
+
+
+def upgrade_legacy_schema():
+    """
+    Converts data in tables created before a model change (create_all() never alters existing tables).
+    Every step is idempotent, so it is safe to run on each startup.
+    """
+    if not inspect(db.engine).has_table('vehicle'):
+        return
+
+    # User.dob / User.dl_expiry: 'YYYY-MM-DD' strings -> DATE.
+    # SQLite needs nothing: SQLAlchemy's Date type already reads and writes that exact string format.
+    if db.engine.dialect.name == 'postgresql':
+        user_columns = {c['name']: c for c in inspect(db.engine).get_columns('user')}
+        for column_name in ('dob', 'dl_expiry'):
+            if column_name in user_columns and not isinstance(user_columns[column_name]['type'], Date):
+                with db.engine.begin() as conn:
+                    conn.execute(text(
+                        f'ALTER TABLE "user" ALTER COLUMN {column_name} TYPE DATE USING {column_name}::date'
+                    ))
+                print(f"✅ Migrated user.{column_name} to DATE.")
+
+    # Booking receipt figures: add the columns, then back-fill rows booked before they existed
+    booking_columns = {c['name'] for c in inspect(db.engine).get_columns('booking')}
+    for column_name, column_type in (('billed_hours', 'FLOAT'), ('subtotal_base', 'INTEGER'), ('gst', 'INTEGER')):
+        if column_name not in booking_columns:
+            with db.engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE booking ADD COLUMN {column_name} {column_type}'))
+            print(f"✅ Added booking.{column_name}.")
+    with db.engine.begin() as conn:
+        legacy_rows = conn.execute(
+            select(Booking.id, Booking.start_date, Booking.end_date, Booking.total_price, Booking.deposit_amount)
+            .where(Booking.billed_hours.is_(None))
+        ).all()
+        if legacy_rows:
+            figures = []
+            for booking_id, start_date, end_date, total_price, deposit_amount in legacy_rows:
+                billed_hours, subtotal_base, gst = legacy_receipt_figures(start_date, end_date, total_price, deposit_amount)
+                figures.append({'b_id': booking_id, 'billed_hours': billed_hours, 'subtotal_base': subtotal_base, 'gst': gst})
+            conn.execute(
+                update(Booking.__table__).where(Booking.__table__.c.id == bindparam('b_id')).values(
+                    billed_hours=bindparam('billed_hours'), subtotal_base=bindparam('subtotal_base'), gst=bindparam('gst')
+                ),
+                figures
+            )
+            print(f"✅ Back-filled receipt figures for {len(figures)} bookings.")
+
+    # Cancellation fee: stored at cancellation from now on. Rows cancelled before the column existed
+    # get the fee the admin dashboard used to compute for them (fee rule applied as of today).
+    if 'cancellation_fee' not in booking_columns:
+        with db.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE booking ADD COLUMN cancellation_fee INTEGER'))
+            now = datetime.utcnow()
+            fees = [
+                {'b_id': booking_id, 'fee': cancellation_fee_for(total_price, booked_at, now)}
+                for booking_id, total_price, booked_at in conn.execute(
+                    select(Booking.id, Booking.total_price, Booking.booked_at).where(Booking.status == 'Cancelled')
+                )
+            ]
+            if fees:
+                conn.execute(
+                    update(Booking.__table__).where(Booking.__table__.c.id == bindparam('b_id'))
+                    .values(cancellation_fee=bindparam('fee')),
+                    fees
+                )
+        print(f"✅ Added booking.cancellation_fee ({len(fees)} cancelled bookings back-filled).")
+
+    # Vehicle review totals: add the columns, then seed them once from the existing reviews
+    vehicle_columns = {c['name'] for c in inspect(db.engine).get_columns('vehicle')}
+    missing = [(name, sql_type) for name, sql_type in (('rating_count', 'INTEGER'), ('rating_sum', 'FLOAT')) if name not in vehicle_columns]
+    if missing:
+        with db.engine.begin() as conn:
+            for column_name, column_type in missing:
+                conn.execute(text(f'ALTER TABLE vehicle ADD COLUMN {column_name} {column_type} NOT NULL DEFAULT 0'))
+            conn.execute(text(
+                'UPDATE vehicle SET '
+                'rating_count = (SELECT COUNT(*) FROM review WHERE review.vehicle_id = vehicle.id), '
+                'rating_sum = (SELECT COALESCE(SUM(review.rating), 0) FROM review WHERE review.vehicle_id = vehicle.id)'
+            ))
+        print("✅ Added and back-filled vehicle review totals.")
+
+    # KYC documents: move files uploaded under static/ to KYC_FOLDER and point their rows at /kyc/
+    with db.engine.begin() as conn:
+        legacy_kyc = conn.execute(text(
+            "SELECT id, kyc_file_path FROM \"user\" WHERE kyc_file_path LIKE '/static/uploads/kyc-%'"
+        )).all()
+        for user_id, legacy_path in legacy_kyc:
+            filename = legacy_path.rsplit('/', 1)[1]
+            legacy_file, kyc_file = os.path.join(UPLOAD_FOLDER, filename), os.path.join(KYC_FOLDER, filename)
+            if os.path.exists(legacy_file):
+                shutil.move(legacy_file, kyc_file)
+            if os.path.exists(kyc_file):
+                conn.execute(
+                    text('UPDATE "user" SET kyc_file_path = :path WHERE id = :id'),
+                    {'path': f"/kyc/{filename}", 'id': user_id}
+                )
+
+    # Vehicle.features: comma-separated string -> JSON list
+    if db.engine.dialect.name == 'postgresql':
+        columns = {c['name']: c for c in inspect(db.engine).get_columns('vehicle')}
+        if 'features' in columns and not isinstance(columns['features']['type'], JSON):
+            with db.engine.begin() as conn:
+                conn.execute(text(
+                    "ALTER TABLE vehicle ALTER COLUMN features TYPE JSON "
+                    "USING to_json(string_to_array(COALESCE(features, ''), ','))"
+                ))
+            print("✅ Migrated vehicle.features to JSON.")
     else:
-        # Create a new super_admin user
-        new_admin = User(
-            firebase_uid=secrets.token_hex(16), # Placeholder UID
-            phone=admin_phone,
-            email=admin_email,
-            password=hashed_password,
-            first_name="Super",
-            last_name="Admin",
-            dob="2000-01-01",
-            role='super_admin',
-            address1="Admin HQ",
-            address2=None,
-            city="Global",
-            state="State",
-            pincode="000000",
-            identity_doc="Aadhar",
-            dl_number="ADMN12345",
-            dl_expiry="2030-01-01",
-            terms_agreed=True,
-            is_approved_host=True,
-            is_active=True # Admin must be active
-        )
-        db.session.add(new_admin)
-        db.session.commit()
-        print(f"✅ New Super Admin user '{admin_email}' created successfully.")
+        # SQLite stores JSON as text, so only the legacy values need rewriting
+        with db.engine.begin() as conn:
+            legacy_rows = conn.execute(text(
+                "SELECT id, features FROM vehicle WHERE features IS NOT NULL AND features NOT LIKE '[%'"
+            )).all()
+            for vehicle_id, raw_features in legacy_rows:
+                conn.execute(
+                    text("UPDATE vehicle SET features = :features WHERE id = :id"),
+                    {'features': json.dumps([f for f in raw_features.split(',') if f]), 'id': vehicle_id}
+                )
+
+    # Emails are matched lower-case at login; fold legacy mixed-case addresses one row at a time, so an
+    # address that would collide (with a stored one, or with another row folding to the same value) is
+    # reported and left as is instead of failing the whole batch
+    user_table = User.__table__
+    with db.engine.begin() as conn:
+        mixed_case = conn.execute(
+            select(user_table.c.id, user_table.c.email)
+            .where(user_table.c.email != func.lower(user_table.c.email))
+            .order_by(user_table.c.id)
+        ).all()
+        if mixed_case:
+            taken = set(conn.execute(
+                select(user_table.c.email).where(user_table.c.email.in_({email.lower() for _, email in mixed_case}))
+            ).scalars())
+            folded = []
+            for user_id, email in mixed_case:
+                if email.lower() in taken:
+                    print(f"⚠️ WARNING: Left user #{user_id} email '{email}' as is: '{email.lower()}' is already in use.")
+                    continue
+                taken.add(email.lower())
+                folded.append({'u_id': user_id, 'folded': email.lower()})
+            if folded:
+                conn.execute(
+                    update(user_table).where(user_table.c.id == bindparam('u_id')).values(email=bindparam('folded')),
+                    folded
+                )
+                print(f"✅ Lower-cased {len(folded)} legacy user emails.")
+
+def create_missing_tables():
+    """create_all() only when a model's table is missing: a warm database costs one table-list query."""
+    if not set(db.metadata.tables) <= set(inspect(db.engine).get_table_names()):
+        db.create_all()
+
+def create_missing_indexes():
+    """
+    Creates model indexes added after their table already existed (create_all() skips existing tables).
+    A warm database costs one index reflection instead of an existence check per index.
+    """
+    existing = {index['name'] for indexes in inspect(db.engine).get_multi_indexes().values() for index in indexes}
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                print(f"✅ Created index {index.name}.")
+
+# --- NEW: Database-enforced booking overlap guard (Postgres) ---
+BOOKING_OVERLAP_CONSTRAINT = 'booking_confirmed_no_overlap'
+booking_overlap_enforced = False # True once the exclusion constraint is known to exist
+
+def ensure_booking_overlap_constraint():
+    """
+    Adds an exclusion constraint so two Confirmed bookings of one vehicle can never overlap ([start, end) ranges,
+    same rule as is_vehicle_available). The INSERT itself then rejects a double booking with an IntegrityError.
+    Postgres only; SQLite keeps the re-check in confirm_booking.
+    """
+    global booking_overlap_enforced
+    if db.engine.dialect.name != 'postgresql':
+        return
+    try:
+        with db.engine.begin() as conn:
+            if not conn.execute(text('SELECT 1 FROM pg_constraint WHERE conname = :name'), {'name': BOOKING_OVERLAP_CONSTRAINT}).scalar():
+                conn.execute(text('CREATE EXTENSION IF NOT EXISTS btree_gist'))
+                conn.execute(text(
+                    f"ALTER TABLE booking ADD CONSTRAINT {BOOKING_OVERLAP_CONSTRAINT} "
+                    "EXCLUDE USING gist (vehicle_id WITH =, tsrange(start_date, end_date) WITH &&) "
+                    "WHERE (status = 'Confirmed')"
+                ))
+                print("✅ Added booking overlap exclusion constraint.")
+        booking_overlap_enforced = True
+    except SQLAlchemyError as e:
+        # e.g. existing overlapping bookings, or no permission to create btree_gist
+        print(f"⚠️ WARNING: Booking overlap constraint not installed; confirm_booking will re-check availability. Error: {e}")
+# ---------------------------------------------------------------
 
 
 # =========================================================================
@@ -351,17 +1054,23 @@ from sqlalchemy import inspect # Import inspect here for use below
 with app.app_context():
     try:
         # This will create tables if they don't exist (and only works once).
-        db.create_all()
+        create_missing_tables()
+        upgrade_legacy_schema()
+        create_missing_indexes()
+        ensure_booking_overlap_constraint()
         print("✅ Database tables checked/created at application startup.")
         
         # --- Create Admin User (Only needed once) ---
         # Check if the 'user' table is even there before querying it and if no super_admin exists
         # NOTE: inspect(db.engine).has_table('user') is a safeguard, but User.query.first() may fail before table creation.
         # We rely on db.create_all() first, then run admin creation logic.
+        # The check and the seed share one transaction, committed once
         if User.query.filter_by(role='super_admin').count() == 0:
              create_admin_user("admin@primedrew.com", "9999999999", "adminpass")
-             print("✅ Super Admin created/verified.")
+             db.session.commit()
+             bootstrap_log.info("✅ Super Admin created/verified.")
         # -------------------------------------------
+        load_registered_phones()
     except Exception as e:
         # This will catch errors related to connecting to the DB/bad URL.
         print(f"❌ CRITICAL DATABASE ERROR at startup: {e}")
@@ -373,6 +1082,44 @@ with app.app_context():
 # ==================================
 
 # --- NEW: GOOGLE MAPS GEOCODING HELPER (CRITICAL FOR ACCURATE MAP MARKERS) ---
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+# One pooled session so repeated geocoding calls reuse the TCP/TLS connection to Google
+_geo_session = requests.Session()
+_geo_session.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+
+GEOCODE_CACHE_TTL = 30 * 24 * 3600 # seconds; addresses don't move
+
+def geocode_cache_key(full_address):
+    return "primedrew:geo:v1:" + hashlib.sha1(full_address.encode()).hexdigest()
+
+@lru_cache(maxsize=2048)
+def _geocode_full_address(full_address, api_key):
+    """
+    Returns (lat, lng) for a normalized address string: process-local LRU first,
+    then Redis (shared by all workers), then Google.
+    Raises LookupError when Google has no result, so failures are never cached.
+    """
+    key = geocode_cache_key(full_address)
+    cached = cache_get(key)
+    if cached is not None:
+        return tuple(orjson.loads(cached))
+
+    response = _geo_session.get(GEOCODE_URL, params={'address': full_address, 'key': api_key}, timeout=(2, 5))
+    response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
+    
+    data = response.json()
+    if data['status'] == 'OK' and data['results']:
+        location = data['results'][0]['geometry']['location']
+        lat_lng = (round(location['lat'], 6), round(location['lng'], 6)) # Store with higher precision
+        cache_set(key, orjson.dumps(lat_lng), GEOCODE_CACHE_TTL)
+        return lat_lng
+    raise LookupError(data.get('status', 'No Status'))
+
 def get_precise_lat_lng(address_line_1, address_line_2, city, state, pincode, api_key):
     """
     Uses Google Geocoding API to get precise latitude and longitude from a full address.
@@ -380,37 +1127,21 @@ def get_precise_lat_lng(address_line_1, address_line_2, city, state, pincode, ap
     """
     # 1. Full address string for best accuracy (Ensuring country is specified for India)
     full_address = f"{address_line_1}, {address_line_2 or ''}, {city}, {state}, India, {pincode}"
-    
-    # 2. Base API URL
-    GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
-
-    # 3. Parameters for the API request
-    params = {
-        'address': full_address,
-        'key': api_key
-    }
+    # Normalized so the same address typed differently hits the same cache entry
+    normalized_address = ' '.join(full_address.lower().split())
     
     # Get fallback location first, in case of failure
-    base_loc = CITY_GEOLOCATION.get(city, {'lat': 20.5937, 'lng': 78.9629})
+    base_lat, base_lng = _CITY_GEO.get((city or '').lower(), DEFAULT_GEO)
+    base_loc = {'lat': base_lat, 'lng': base_lng}
 
     try:
-        # 4. Make the request using the requests library
-        response = requests.get(GEOCODE_URL, params=params)
-        response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
-        
-        data = response.json()
-        
-        # 5. Process the JSON response
-        if data['status'] == 'OK' and data['results']:
-            location = data['results'][0]['geometry']['location']
-            return {
-                'lat': round(location['lat'], 6), # Store with higher precision
-                'lng': round(location['lng'], 6) # Store with higher precision
-            }
-        else:
-            # Fallback to city-center if precise address fails
-            print(f"⚠️ Geocoding failed for address: {full_address}. Status: {data.get('status', 'No Status')}. Falling back to city center estimate.")
-            return base_loc
+        lat, lng = _geocode_full_address(normalized_address, api_key)
+        return {'lat': lat, 'lng': lng}
+
+    except LookupError as e:
+        # Fallback to city-center if precise address fails
+        print(f"⚠️ Geocoding failed for address: {full_address}. Status: {e}. Falling back to city center estimate.")
+        return base_loc
 
     except requests.exceptions.RequestException as e:
         print(f"❌ Geocoding API Request Error: {e}. Falling back to city center estimate.")
@@ -443,8 +1174,7 @@ def send_approval_sms(recipient_phone_number, host_name):
     )
     
     try:
-        client = Client(account_sid, auth_token)
-        message = client.messages.create(
+        message = twilio_client().messages.create(
             to=recipient_phone_number,
             from_=twilio_number,
             body=message_body
@@ -454,9 +1184,86 @@ def send_approval_sms(recipient_phone_number, host_name):
         print(f"❌ SMS Failed to send to {recipient_phone_number}. Error: {e}")
         return False
     return True
+
+# Geocoding runs on its own small pool so adding a vehicle never waits on Google
+_geocode_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='geocode')
+
+def _geocode_and_update_vehicle(vehicle_id, address):
+    loc = get_precise_lat_lng(**address)
+    with app.app_context():
+        try:
+            db.session.execute(
+                update(Vehicle).where(Vehicle.id == vehicle_id).values(latitude=loc['lat'], longitude=loc['lng'])
+            )
+            db.session.commit()
+            invalidate_inventory_cache()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            print(f"❌ Could not store geocode for vehicle {vehicle_id}: {e}")
+
+def geocode_vehicle_later(vehicle_id, **address):
+    """
+    Write-behind geocoding: the vehicle is saved with city-center coordinates and this
+    replaces them with the precise location once Google answers.
+    """
+    _geocode_executor.submit(_geocode_and_update_vehicle, vehicle_id, address)
+
+# Twilio round trips run off the request thread so admin actions return immediately
+_sms_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='sms')
+
+def _log_sms_result(future):
+    try:
+        if not future.result():
+            print("⚠️ Background SMS was not sent (see the error above).")
+    except Exception as e:
+        print(f"❌ Background SMS task crashed. Error: {e}")
+
+def send_approval_sms_async(recipient_phone_number, host_name):
+    """Queues send_approval_sms on the background SMS pool."""
+    future = _sms_executor.submit(send_approval_sms, recipient_phone_number, host_name)
+    future.add_done_callback(_log_sms_result)
+    return future
 # ------------------------------------------------------------------------
 
 
+def current_user():
+    """Returns the logged-in User, loaded at most once per request (cached on flask.g)."""
+    user = getattr(g, '_user', None)
+    if user is None:
+        user_id = session.get('user_id')
+        if user_id is None:
+            return None
+        # Session.get() checks the identity map before issuing a SELECT
+        user = db.session.get(User, user_id)
+        g._user = user
+    return user
+
+# Column-only select for the login lookup: one narrow Row, no ORM identity-map bookkeeping
+AUTH_COLUMNS = tuple(getattr(User, name) for name in AUTH_FIELDS)
+
+def _get_auth_user(field, value):
+    """
+    Read-through cache for the login lookup. Returns a lightweight record carrying only AUTH_FIELDS
+    (not an ORM instance), or None if no user matches.
+    """
+    key = user_cache_key(field, value)
+    cached = cache_get(key)
+    if cached is not None:
+        return SimpleNamespace(**msgpack.unpackb(cached))
+    row = db.session.query(*AUTH_COLUMNS).filter(getattr(User, field) == value).first()
+    if row is None:
+        return None
+    record = row._asdict()
+    cache_set(key, msgpack.packb(record), AUTH_CACHE_TTL)
+    return SimpleNamespace(**record)
+
+def get_user_by_phone(phone):
+    return _get_auth_user('phone', phone)
+
+def get_user_by_email(email):
+    return _get_auth_user('email', email)
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -470,8 +1277,7 @@ def host_required(f):
     @wraps(f)
     @login_required
     def decorated_function(*args, **kwargs):
-        user_id = session.get('user_id')
-        user = User.query.get(user_id) # Fetch user status from DB
+        user = current_user() # Fetch user status from DB (cached for the rest of the request)
 
         # --- BLOCK CHECK FOR HOSTS (NEW) ---
         if user and not user.is_active:
@@ -515,7 +1321,7 @@ def admin_required(f):
         
         # Verify the user exists in DB and still holds the role
         if user_id is not None and user_id > 0:
-            user = User.query.get(user_id)
+            user = current_user()
             if not user or user.role != 'super_admin':
                 session.clear()
                 flash("❌ Your administrative access has been revoked or user was deleted. Please log in again.", 'error')
@@ -525,6 +1331,47 @@ def admin_required(f):
     return decorated_function
 
 
+@app.after_request
+def cache_hashed_assets(response):
+    # The filename changes whenever the content does, so browsers/CDN may keep it forever
+    if request.endpoint == 'static' and (request.view_args or {}).get('filename') == SUB_CITY_MAP_ASSET:
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return response
+
+# --- NEW: CACHING FOR STATIC INFORMATIONAL PAGES ---
+STATIC_PAGE_TTL = 3600 # seconds
+# Part of the cache key so a deploy never serves the previous release's HTML (Render sets RENDER_GIT_COMMIT)
+STATIC_PAGE_CACHE_VERSION = os.environ.get('RENDER_GIT_COMMIT', 'dev')[:12]
+
+def cached_static_page(f):
+    """
+    Caches a template-only page's HTML in Redis and lets browsers/CDNs keep it for an hour.
+    base.html renders the profile popup and flash messages from the session, so only anonymous
+    visitors with no pending flashes get the shared copy; everyone else gets a normal render.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get('logged_in') or '_flashes' in session:
+            return f(*args, **kwargs)
+
+        key = f"primedrew:page:{STATIC_PAGE_CACHE_VERSION}:{request.path}"
+        cached = cache_get(key)
+        if cached is not None:
+            html = cached.decode()
+        else:
+            html = f(*args, **kwargs)
+            cache_set(key, html, STATIC_PAGE_TTL)
+
+        response = make_response(html)
+        response.headers['Cache-Control'] = f'public, max-age={STATIC_PAGE_TTL}, stale-while-revalidate=86400'
+        response.vary.add('Cookie') # logging in changes the cookie, so browsers refetch the personalised page
+        return response
+    return decorated_function
+# ----------------------------------------------------
+
+
 # --- MODIFIED: Dynamic Deposit Calculation Function ---
 def calculate_deposit(subtotal, total_hours):
     """Calculates the dynamic refundable deposit based on duration."""
@@ -548,68 +1395,97 @@ def calculate_deposit(subtotal, total_hours):
 # -----------------------------------------------
 
 
+# Booking windows are naive 'YYYY-MM-DD HH:MM:SS' strings (the datetime-local 'T' is tolerated).
+# strptime keeps that shape strict: offsets like +05:30 and date-only values raise ValueError, so a
+# mixed aware/naive pair can never reach the datetime arithmetic below.
+BOOKING_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def parse_booking_datetime(value):
+    if not isinstance(value, str):
+        raise ValueError(f"Expected a date string, got {type(value).__name__}")
+    return _strptime(value.replace('T', ' ', 1), BOOKING_DATETIME_FORMAT)
+
+
 # --- MODIFIED: Long-Term Rental Pricing Logic (Discount) ---
 def price_for_server(base_price_per_hour, fuel_type, start_date_str_iso, end_date_str_iso):
-    DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
-    
     if not start_date_str_iso or not end_date_str_iso:
         return 0 
 
     try:
-        s = datetime.strptime(start_date_str_iso, DATE_FORMAT)
-        e = datetime.strptime(end_date_str_iso, DATE_FORMAT)
+        s = parse_booking_datetime(start_date_str_iso)
+        e = parse_booking_datetime(end_date_str_iso)
     except ValueError as ve:
         print(f"Date Parsing Error in price_for_server: {ve}")
         return 0 
 
+    # All arithmetic below is integer (seconds/minutes and paise) to avoid float drift
     time_difference = e - s
-    total_hours = time_difference.total_seconds() / 3600
+    total_seconds = time_difference.days * 86400 + time_difference.seconds
     
-    if total_hours <= 0: 
+    if total_seconds <= 0: 
         return 0 
     
-    billed_hours = total_hours
-    if total_hours < 24:
-        billed_hours = math.ceil(total_hours)
+    if total_seconds < 24 * 3600:
+        # Short rentals are billed per started hour
+        billed_minutes = ((total_seconds + 3599) // 3600) * 60
+    else:
+        billed_minutes = total_seconds // 60
     
-    subtotal = billed_hours * base_price_per_hour
+    price_paise_per_hour = round(base_price_per_hour * 100)
+    subtotal_paise = billed_minutes * price_paise_per_hour // 60
     
     # Apply Fuel Surcharge/Discount
     if fuel_type == 'Electric': 
-        subtotal *= 0.95
+        subtotal_paise = subtotal_paise * 95 // 100
     elif fuel_type == 'Diesel':
-        subtotal *= 1.05
+        subtotal_paise = subtotal_paise * 105 // 100
     
     # --- MODIFIED LONG-TERM DISCOUNT LOGIC ---
-    if total_hours >= 48 and total_hours < 96:
-        subtotal *= 0.95 # 5% discount
-    elif total_hours >= 96: 
-        subtotal *= 0.85 # 15% discount 
+    if 48 * 3600 <= total_seconds < 96 * 3600:
+        subtotal_paise = subtotal_paise * 95 // 100 # 5% discount
+    elif total_seconds >= 96 * 3600: 
+        subtotal_paise = subtotal_paise * 85 // 100 # 15% discount 
     # -----------------------------------------
     
-    return round(subtotal)
+    # Paise -> rupees, rounding half up
+    return (subtotal_paise + 50) // 100
 # -----------------------------------------------------------
 
 
 def is_vehicle_available(vehicle_db_id, start_date_str_iso, end_date_str_iso):
-    DATE_FORMAT_IN = '%Y-%m-%d %H:%M:%S'
     try:
-        start_dt = datetime.strptime(start_date_str_iso, DATE_FORMAT_IN)
-        end_dt = datetime.strptime(end_date_str_iso, DATE_FORMAT_IN)
+        start_dt = parse_booking_datetime(start_date_str_iso)
+        end_dt = parse_booking_datetime(end_date_str_iso)
     except ValueError:
         return False
 
-    overlaps = Booking.query.filter(
+    # Only the id is needed to detect an overlap, so skip hydrating a full Booking row
+    overlap_id = db.session.query(Booking.id).filter(
         Booking.vehicle_id == vehicle_db_id,
         Booking.status == 'Confirmed',
         Booking.start_date < end_dt, 
         Booking.end_date > start_dt
     ).first()
-    return overlaps is None 
+    return overlap_id is None 
+
+def unavailable_vehicle_ids(vehicle_ids, start_dt, end_dt):
+    """Returns the subset of vehicle_ids with a confirmed booking overlapping [start_dt, end_dt), in one query."""
+    if not vehicle_ids:
+        return set()
+    rows = db.session.query(Booking.vehicle_id).filter(
+        Booking.vehicle_id.in_(vehicle_ids),
+        Booking.status == 'Confirmed',
+        Booking.start_date < end_dt,
+        Booking.end_date > start_dt
+    ).distinct().all()
+    return {vehicle_id for (vehicle_id,) in rows}
 
 # --- NEW: Review Eligibility Check ---
-def is_booking_reviewable(booking):
-    """Checks if a booking is confirmed, past its end date, and has no existing review."""
+def is_booking_reviewable(booking, has_review=None):
+    """
+    Checks if a booking is confirmed, past its end date, and has no existing review.
+    Pass has_review when it is already known (e.g. batch-loaded for a list) to skip the lookup.
+    """
     if booking.status != 'Confirmed':
         return False
         
@@ -617,18 +1493,27 @@ def is_booking_reviewable(booking):
     if booking.end_date > datetime.utcnow():
         return False
 
-    # Check if a review already exists for this booking
-    existing_review = Review.query.filter_by(booking_id=booking.id).first()
-    if existing_review:
+    # Check if a review already exists for this booking (EXISTS returns one boolean, no Review row)
+    if has_review is None:
+        has_review = db.session.query(exists().where(Review.booking_id == booking.id)).scalar()
+    if has_review:
         return False
 
     return True
 # -------------------------------------
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    flash("❌ The uploaded file is too large. Maximum size is 8 MB.", 'error')
+    return redirect(request.referrer or url_for('index'))
+
 # ==================================
 # === ROUTES (Authentication) ===
 # ==================================
 
+# Deliberately the same for an unknown login ID and a wrong password
+INVALID_LOGIN_MSG = "Invalid login ID or password. Please try again."
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -637,59 +1522,73 @@ def login():
         password = request.form.get('password')
         
         user = None
-        
-        # 1. Try finding user by phone number (if input looks like digits)
-        if login_id and login_id.isdigit() and len(login_id) >= 10:
-            user = User.query.filter_by(phone=login_id).first()
-            
-        # 2. If not found or if it looks like an email, try email
-        if not user and login_id and '@' in login_id:
-            user = User.query.filter_by(email=login_id).first()
+        login_id = (login_id or '').strip()
+
+        # Classify the identifier once so at most one lookup runs
+        phone_digits = login_id.lstrip('+')
+        if '@' in login_id:
+            user = get_user_by_email(login_id.lower())
+        elif phone_digits.isdigit() and len(phone_digits) >= 10:
+            user = get_user_by_phone(phone_digits)
         
         
-        # --- GENERAL USER/ADMIN LOGIN CHECK (Priority 1) ---
+        # Always run exactly one password verify, even for an unknown login ID, so the response time
+        # doesn't reveal whether an account exists (the blocked check also comes after the verify)
         if user:
-            
+            password_ok, needs_rehash = verify_password(user.password, password or '')
+        else:
+            verify_password(DUMMY_PASSWORD_HASH, password or '')
+            password_ok = needs_rehash = False
+
+        # --- GENERAL USER/ADMIN LOGIN CHECK (Priority 1) ---
+        if password_ok:
             # --- NEW: ACTIVE STATUS CHECK (APPLIES TO ALL ROLES) ---
             if not user.is_active:
                 flash("❌ Your account has been temporarily blocked by the Administrator. Please contact support.", 'error')
                 return render_template('login.html', error="Your account has been blocked. Please contact support.")
             # --------------------------------------------------------
 
-            # Check if the user is a super_admin or a regular user/host
-            if check_password_hash(user.password, password):
-                session['user_id'] = user.id
-                session['logged_in'] = True
-                # Set user name based on role
-                session['user_name'] = user.first_name if user.role != 'super_admin' else 'Super Admin' 
-                session['user_role'] = user.role
-                
-                # --- START OF REQUIRED CHANGE FOR PROFILE POPUP ---
-                session['user_email'] = user.email # <--- NEW: Email stored in session
-                session['user_phone'] = user.phone # <--- NEW: Phone stored in session
-                # --- END OF REQUIRED CHANGE FOR PROFILE POPUP ---
-                
-                # Check for unapproved host status at login
-                if user.role == 'host' and not user.is_approved_host:
-                    flash("⚠️ Host registration successful, but you must be approved by the Admin before listing vehicles.", 'warning')
-                
-                flash(f"🎉 Login Successful! Welcome, {session['user_name']}.", 'success')
-                
-                next_url = session.pop('next_url', url_for('index'))
-                
-                if user.role == 'super_admin':
-                    return redirect(url_for('admin_dashboard'))
-                # Hosts go to their specific dashboard
-                if user.role == 'host':
-                    return redirect(url_for('host_dashboard'))
-                
-                return redirect(next_url)
-            else:
-                # Password check failed
-                return render_template('login.html', error="Invalid login ID or password. Please try again.")
-        
-        # If no user found in DB (by phone or email)
-        return render_template('login.html', error="Invalid login ID or password. Please try again.")
+            if needs_rehash:
+                # Transparently move legacy Werkzeug hashes (and Argon2 hashes with outdated parameters)
+                # to the current Argon2 settings on successful login
+                # (user is a cached auth record, so write through a bulk UPDATE rather than the ORM)
+                try:
+                    User.query.filter_by(id=user.id).update({'password': hash_password(password)})
+                    db.session.commit()
+                    invalidate_user_cache(user.phone, user.email)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Password Rehash Error: {e}")
+
+            session['user_id'] = user.id
+            session['logged_in'] = True
+            # Set user name based on role
+            session['user_name'] = user.first_name if user.role != 'super_admin' else 'Super Admin' 
+            session['user_role'] = user.role
+            
+            # --- START OF REQUIRED CHANGE FOR PROFILE POPUP ---
+            session['user_email'] = user.email # <--- NEW: Email stored in session
+            session['user_phone'] = user.phone # <--- NEW: Phone stored in session
+            # --- END OF REQUIRED CHANGE FOR PROFILE POPUP ---
+            
+            # Check for unapproved host status at login
+            if user.role == 'host' and not user.is_approved_host:
+                flash("⚠️ Host registration successful, but you must be approved by the Admin before listing vehicles.", 'warning')
+            
+            flash(f"🎉 Login Successful! Welcome, {session['user_name']}.", 'success')
+            
+            next_url = session.pop('next_url', url_for('index'))
+            
+            if user.role == 'super_admin':
+                return redirect(url_for('admin_dashboard'))
+            # Hosts go to their specific dashboard
+            if user.role == 'host':
+                return redirect(url_for('host_dashboard'))
+            
+            return redirect(next_url)
+
+        # Unknown login ID or wrong password: one terminal response for both
+        return render_template('login.html', error=INVALID_LOGIN_MSG)
             
     return render_template('login.html', error=None) 
 
@@ -703,8 +1602,10 @@ def check_phone_exists():
     if not phone:
         return jsonify({'exists': False, 'message': 'Phone number not provided.'}), 400
 
-    user_by_phone = User.query.filter_by(phone=phone).first()
-    if user_by_phone:
+    registered = is_registered_phone(phone)
+    if registered is None:
+        registered = db.session.query(exists().where(User.phone == phone)).scalar()
+    if registered:
         return jsonify({'exists': True, 'message': 'This phone number is already registered. Please log in.'})
 
     return jsonify({'exists': False})
@@ -714,7 +1615,7 @@ def register():
     if request.method == 'POST':
         firebase_uid = request.form.get('firebase_uid')
         phone = request.form.get('phone')
-        email = request.form.get('email')
+        email = (request.form.get('email') or '').strip().lower() # stored lower-case to match the login lookup
         password = request.form.get('password')
         role = request.form.get('role')
 
@@ -726,15 +1627,11 @@ def register():
 
         file = request.files['kyc_document']
         if file and allowed_file(file.filename):
-            try:
-                filename = secure_filename(file.filename)
-                unique_filename = f"kyc-{phone}-{datetime.now().strftime('%Y%m%d%H%M%S')}-{filename}"
-                save_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(save_path)
-                kyc_file_path = url_for('static', filename=f'uploads/{unique_filename}')
-            except Exception as e:
-                print(f"KYC File Upload Error: {e}")
-                return render_template('registration_form.html', error="Error uploading Driving Licence. Please try again."), 400
+            # Only the name is decided here; the file is written once the user row has been inserted
+            filename = secure_filename(file.filename)
+            unique_filename = f"kyc-{phone}-{secrets.token_hex(8)}-{filename}"
+            save_path = os.path.join(app.config['KYC_FOLDER'], unique_filename)
+            kyc_file_path = f"/kyc/{unique_filename}" # served by kyc_document()
         else:
                 return render_template('registration_form.html', error="Invalid file type for Driving Licence. Only images and PDFs are allowed."), 400
         # ----------------------------
@@ -742,10 +1639,14 @@ def register():
         if not firebase_uid or not phone or not email:
             return render_template('registration_form.html', error="Error: Missing essential data."), 400
 
-        if User.query.filter_by(phone=phone).first() or User.query.filter_by(email=email).first():
-            return render_template('registration_form.html', error="Error: Mobile number or email is already registered."), 409
+        try:
+            # Native DATE columns: parse the <input type="date"> values once, here
+            dob = date.fromisoformat(request.form.get('dob') or '')
+            dl_expiry = date.fromisoformat(request.form.get('dlExpiry') or '')
+        except ValueError:
+            return render_template('registration_form.html', error="Error: Please enter a valid date of birth and licence expiry date."), 400
 
-        hashed_password = generate_password_hash(password) 
+        hashed_password = hash_password(password) 
         
         is_approved = True if role == 'renter' else False 
         is_active_default = True
@@ -754,10 +1655,10 @@ def register():
             new_user = User(
                 firebase_uid=firebase_uid, phone=phone, email=email, 
                 password=hashed_password, 
-                first_name=request.form.get('firstName'), last_name=request.form.get('lastName'), dob=request.form.get('dob'), role=role,
+                first_name=request.form.get('firstName'), last_name=request.form.get('lastName'), dob=dob, role=role,
                 address1=request.form.get('address1'), address2=request.form.get('address2'), city=request.form.get('city'), state=request.form.get('state'), pincode=request.form.get('pincode'), 
                 identity_doc='dl', # Hardcoded as Driving Licence is the only option
-                dl_number=request.form.get('dlNumber'), dl_expiry=request.form.get('dlExpiry'), 
+                dl_number=request.form.get('dlNumber'), dl_expiry=dl_expiry, 
                 experience=request.form.get('experience', 0),
                 terms_agreed='terms' in request.form,
                 is_approved_host=is_approved, 
@@ -765,24 +1666,61 @@ def register():
                 kyc_file_path=kyc_file_path
             )
             db.session.add(new_user)
+            # INSERT first (duplicates fail here, before anything touches the disk), then write the
+            # KYC file, then commit: the row and the file end up existing together or not at all
+            db.session.flush()
+            save_upload(file, save_path)
             db.session.commit()
+            invalidate_user_cache(phone, email)
+            remember_registered_phone(phone)
             
             flash("✅ Registration Successful! Please log in.", 'success')
             return redirect(url_for('login'))
 
+        except IntegrityError:
+            # Duplicates are caught by the UNIQUE constraints on phone/email at INSERT time (no racy pre-check)
+            db.session.rollback()
+            discard_upload(save_path)
+            return render_template('registration_form.html', error="Error: Mobile number or email is already registered."), 409
+        except OSError as e:
+            db.session.rollback()
+            discard_upload(save_path)
+            print(f"KYC File Upload Error: {e}")
+            return render_template('registration_form.html', error="Error uploading Driving Licence. Please try again."), 400
         except Exception as e:
             db.session.rollback()
+            discard_upload(save_path)
             print(f"Database Save Error: {e}")
             return render_template('registration_form.html', error="An unexpected error occurred while saving user data. Try again."), 500
 
+# --- NEW: PROTECTED KYC DOCUMENT ROUTE ---
+@app.route('/kyc/<path:filename>')
+@login_required
+def kyc_document(filename):
+    """Serves a KYC document to the user who uploaded it or to a Super Admin."""
+    user = current_user()
+    if not user or (user.role != 'super_admin' and user.kyc_file_path != f"/kyc/{filename}"):
+        flash("❌ Unauthorized: You cannot view this document.", 'error')
+        return redirect(url_for('dashboard'))
+
+    if safe_join(KYC_FOLDER, filename) is None:
+        return "Document not found.", 404
+
+    accel_prefix = app.config['KYC_ACCEL_REDIRECT_PREFIX']
+    if accel_prefix:
+        # nginx streams the file itself (sendfile) from its internal location
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{filename}"
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return response
+    # Emits X-Sendfile instead of the body when USE_X_SENDFILE is on
+    return send_from_directory(KYC_FOLDER, filename)
+# -----------------------------------------
+
 @app.route('/logout')
 def logout():
-    session.pop('logged_in', None)
-    session.pop('user_name', None)
-    session.pop('user_id', None)
-    session.pop('user_role', None)
-    session.pop('user_email', None) # Clear new session variables
-    session.pop('user_phone', None) # Clear new session variables
+    # Wipe every key at once (including any added later, e.g. next_url or temp booking data)
+    session.clear()
     flash("👋 You have been logged out.", 'info') 
     return redirect(url_for('index'))
 
@@ -816,11 +1754,12 @@ def reset_password_via_firebase():
 
     try:
         # 1. Hash the new password securely
-        hashed_password = generate_password_hash(new_password)
+        hashed_password = hash_password(new_password)
         
         # 2. Update the password in the database
         user.password = hashed_password
         db.session.commit()
+        invalidate_user_cache(user.phone, user.email)
         
         return jsonify({'success': True, 'message': 'Password successfully reset. You can now log in.'}), 200
 
@@ -835,25 +1774,30 @@ def reset_password_via_firebase():
 # ==================================
 
 @app.route('/')
+@cached_static_page
 def index():
     return render_template('index.html') 
 
 @app.route('/about')
+@cached_static_page
 def about_page():
     return render_template('about.html')
 
 @app.route('/contact')
+@cached_static_page
 def contact_page():
     """Renders the contact page template."""
     return render_template('contact_page.html')
 
 # --- NEW ROUTES FOR LEGAL PAGES ---
 @app.route('/privacy-terms')
+@cached_static_page
 def privacy_terms_page():
     """Renders the page covering Privacy Policy and Terms & Conditions."""
     return render_template('privacy_terms.html')
 
 @app.route('/faq')
+@cached_static_page
 def faq_page():
     """Renders the help center and frequently asked questions page."""
     return render_template('faq.html')
@@ -923,8 +1867,7 @@ def dashboard():
         # Fix: Ensure admin always redirects to the admin dashboard endpoint
         return redirect(url_for('admin_dashboard')) 
         
-    user_id = session.get('user_id')
-    user = User.query.get(user_id)
+    user = current_user()
     
     if user_role == 'host':
         # Host: Show status if unapproved, then redirect to host_dashboard (if approved)
@@ -937,22 +1880,47 @@ def dashboard():
     user_name = session.get('user_name', 'User')
     return f"<h1>Dashboard</h1><p>Hello, {user_name}. You are logged in as a {user_role}.</p><p><a href='{url_for('search_page')}'>Find a Vehicle</a> | <a href='/my-bookings'>View My Bookings</a> | <a href='/logout'>Logout</a></p>"
     
+MY_BOOKINGS_PAGE_SIZE = 50
+
 @app.route('/my-bookings')
 @login_required
 def my_bookings():
     user_id = session.get('user_id')
-    
-    bookings = Booking.query.options(
-        joinedload(Booking.vehicle_info).joinedload(Vehicle.host)
-    ).filter_by(user_id=user_id).order_by(Booking.start_date.desc()).all()
-    
+    before_id = request.args.get('before', type=int)
+    
+    # selectinload batches vehicles and hosts into one IN (...) query each instead of a wide outer join;
+    # load_only keeps those queries to the columns the page actually shows
+    query = Booking.query.options(
+        selectinload(Booking.vehicle_info).load_only(
+            Vehicle.id, Vehicle.name, Vehicle.image_url, Vehicle.vehicle_id_code, Vehicle.host_id
+        ).selectinload(Vehicle.host).load_only(User.first_name)
+    ).filter_by(user_id=user_id)
+
+    # Keyset pagination on (start_date, id): "?before=<booking id>" continues after that booking
+    if before_id:
+        cursor_start = db.session.query(Booking.start_date).filter_by(id=before_id, user_id=user_id).scalar_subquery()
+        query = query.filter(or_(
+            Booking.start_date < cursor_start,
+            and_(Booking.start_date == cursor_start, Booking.id < before_id)
+        ))
+    bookings = query.order_by(Booking.start_date.desc(), Booking.id.desc()).limit(MY_BOOKINGS_PAGE_SIZE + 1).all()
+    next_before = bookings[MY_BOOKINGS_PAGE_SIZE - 1].id if len(bookings) > MY_BOOKINGS_PAGE_SIZE else None
+    bookings = bookings[:MY_BOOKINGS_PAGE_SIZE]
+    
+    # One query for every already-reviewed booking instead of one EXISTS per row
+    reviewed_ids = {
+        booking_id for (booking_id,) in db.session.query(Review.booking_id).filter(
+            Review.booking_id.in_([b.id for b in bookings])
+        )
+    } if bookings else set()
+
     booking_history = []
     for booking in bookings:
         vehicle = booking.vehicle_info
         host_name = vehicle.host.first_name if vehicle and vehicle.host else "N/A"
         
         # --- NEW REVIEW/REFUND LOGIC ---
-        reviewable = is_booking_reviewable(booking)
+        reviewable = is_booking_reviewable(booking, has_review=booking.id in reviewed_ids)
         # ------------------------
 
         booking_history.append({
@@ -973,7 +1941,7 @@ def my_bookings():
             'vehicle_db_id': vehicle.id if vehicle else None,
         })
         
-    return render_template('my_bookings.html', bookings=booking_history)
+    return render_template('my_bookings.html', bookings=booking_history, next_before=next_before)
 
 # --- NEW ROUTE FOR RECEIPT DOWNLOAD ---
 @app.route('/receipt/<int:booking_id>')
@@ -995,15 +1963,15 @@ def download_receipt(booking_id):
     host = vehicle.host
     customer = booking.customer # Assuming customer details are needed
 
-    # Calculate duration details for the receipt
-    time_difference = booking.end_date - booking.start_date
-    total_hours = time_difference.total_seconds() / 3600
-    billed_hours = math.ceil(total_hours) if total_hours < 24 else total_hours
-    
-    # Calculate components (for display verification only, total_price is final)
-    subtotal = booking.total_price - booking.deposit_amount
-    gst = round(subtotal * 0.18)
-    subtotal_base = subtotal - gst # Approximate pre-tax subtotal
+    # Duration and price components were frozen on the row when the booking was confirmed
+    if booking.billed_hours is not None:
+        billed_hours, subtotal_base, gst = booking.billed_hours, booking.subtotal_base, booking.gst
+    else:
+        billed_hours, subtotal_base, gst = legacy_receipt_figures(
+            booking.start_date, booking.end_date, booking.total_price, booking.deposit_amount
+        )
+    if float(billed_hours).is_integer():
+        billed_hours = int(billed_hours) # "3 Hours", not "3.0 Hours"
     
     # Check if this booking was a cancellation (to adjust receipt title)
     is_cancellation_refund = booking.status == 'Cancelled' and booking.refund_status != 'NotApplicable'
@@ -1013,9 +1981,9 @@ def download_receipt(booking_id):
         'vehicle': vehicle,
         'host': host,
         'customer': customer,
-        'billed_hours': round(billed_hours, 1),
+        'billed_hours': billed_hours,
         'duration_str': f"{billed_hours:.1f} Hours",
-        'subtotal_base': round(subtotal_base), 
+        'subtotal_base': subtotal_base, 
         'gst': gst,
         'deposit': round(booking.deposit_amount),
         'final_price': round(booking.total_price),
@@ -1030,11 +1998,9 @@ def download_receipt(booking_id):
 
 @app.route('/search')
 def search_page():
-    inventory_data = get_inventory().get_json() 
     # MODIFIED: Pass sub-city map and Google Maps API Key to the template
     return render_template('vehicle_search.html', 
-                             inventory_json=json.dumps(inventory_data),
-                             sub_city_map_json=json.dumps(SUB_CITY_MAP),
+                             inventory_json=inventory_json(),
                              google_maps_api_key=app.config['GOOGLE_MAPS_API_KEY'])
 
 
@@ -1043,23 +2009,64 @@ def search_page():
 # ==================================
 
 # --- DYNAMIC PRICE SUGGESTION LOGIC (NEW) ---
+DEMAND_SNAPSHOT_MAX_AGE = timedelta(minutes=15)
+
+# Hot demand statements are built once with bound parameters, so each call only binds values and
+# the engine's compiled-statement cache serves the SQL
+DEMAND_BY_CITY_TYPE = select(Vehicle.city, Vehicle.type, func.count(Booking.id)).join_from(Booking, Vehicle).where(
+    Booking.status == 'Confirmed',
+    Booking.booked_at >= bindparam('since')
+).group_by(Vehicle.city, Vehicle.type)
+DEMAND_SNAPSHOT_REFRESHED_AT = select(DemandSnapshotRefresh.refreshed_at).where(DemandSnapshotRefresh.id == 1)
+DEMAND_SNAPSHOT_FOR_CITY = select(DemandSnapshot.vehicle_type, DemandSnapshot.count_30d).where(
+    DemandSnapshot.city == bindparam('city')
+)
+
+def refresh_demand_snapshot():
+    """Rebuilds the DemandSnapshot table for every city in one GROUP BY pass and one transaction."""
+    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
+    rows = db.session.execute(DEMAND_BY_CITY_TYPE, {'since': thirty_days_ago}).all()
+
+    now = datetime.utcnow()
+    DemandSnapshot.query.delete(synchronize_session=False)
+    if rows:
+        db.session.execute(insert(DemandSnapshot), [
+            {'city': city, 'vehicle_type': v_type, 'count_30d': count, 'computed_at': now}
+            for city, v_type, count in rows
+        ])
+    # Freshness lives outside the snapshot rows: a rebuild with nothing to count is still a rebuild
+    db.session.merge(DemandSnapshotRefresh(id=1, refreshed_at=now))
+    db.session.commit()
+    return len(rows)
+
+def demand_counts_by_type(city):
+    """Reads a city's per-type counts from the snapshot, rebuilding it first if it is older than DEMAND_SNAPSHOT_MAX_AGE."""
+    refreshed_at = db.session.execute(DEMAND_SNAPSHOT_REFRESHED_AT).scalar()
+    if refreshed_at is None or datetime.utcnow() - refreshed_at > DEMAND_SNAPSHOT_MAX_AGE:
+        try:
+            refresh_demand_snapshot()
+        except SQLAlchemyError as e:
+            # Another worker rebuilt it concurrently; whatever is committed is recent enough to serve.
+            db.session.rollback()
+            print(f"⚠️ Demand snapshot refresh skipped: {e}")
+    return dict(db.session.execute(DEMAND_SNAPSHOT_FOR_CITY, {'city': city}).all())
+
+@app.cli.command('refresh-demand-snapshot')
+def refresh_demand_snapshot_command():
+    """Rebuild the demand snapshot (run from a cron job, e.g. nightly)."""
+    count = refresh_demand_snapshot()
+    print(f"✅ Demand snapshot rebuilt: {count} city/type rows.")
+
 def get_demand_insights(current_user_city):
     """
     Calculates demand insights based on confirmed bookings in the host's city 
     and suggests whether the host should raise or maintain their price.
+    Counts come from the demand snapshot, so they can lag new bookings by up to DEMAND_SNAPSHOT_MAX_AGE.
     """
+    # 1. Analyze Demand by Vehicle Type: confirmed bookings in the host's city over the last 30 days, read from the snapshot
+    demand_by_type = demand_counts_by_type(current_user_city)
     
-    # Analyze bookings confirmed in the last 30 days
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    
-    # Fetch all relevant confirmed bookings in the host's city
-    recent_bookings = db.session.query(Booking).join(Vehicle).filter(
-        Booking.status == 'Confirmed',
-        Vehicle.city == current_user_city,
-        Booking.booked_at >= thirty_days_ago
-    ).all()
-    
-    total_bookings = len(recent_bookings)
+    total_bookings = sum(demand_by_type.values())
     
     if total_bookings < 10:
         return {
@@ -1068,12 +2075,6 @@ def get_demand_insights(current_user_city):
             'type_data': []
         }
 
-    # 1. Analyze Demand by Vehicle Type
-    demand_by_type = {}
-    for booking in recent_bookings:
-        v_type = booking.vehicle_info.type 
-        demand_by_type[v_type] = demand_by_type.get(v_type, 0) + 1
-
     # 2. Find the highest demand type
     max_bookings = 0
     most_demanded_type = 'N/A'
@@ -1104,15 +2105,71 @@ def get_demand_insights(current_user_city):
 # ----------------------------------------------------------------------
 
 
+HOST_VEHICLES_PAGE_SIZE = 50
+
+def host_listed_vehicles(host_id, before_id=None):
+    """
+    Loads one page of a host's vehicles (newest first) with only their confirmed bookings attached,
+    plus a has_future_booking flag for the edit button. Two queries regardless of fleet size;
+    cancelled/completed bookings never leave the database.
+    Returns (vehicles, next_before, total vehicle count); "?before=<vehicle id>" continues after that vehicle.
+    """
+    # load_only: the listing cards never show specification, coordinates, rating etc.
+    query = Vehicle.query.options(load_only(
+        Vehicle.id, Vehicle.vehicle_id_code, Vehicle.name, Vehicle.brand, Vehicle.type, Vehicle.city,
+        Vehicle.sub_city, Vehicle.base_price, Vehicle.image_url, Vehicle._features, Vehicle.is_available
+    )).filter_by(host_id=host_id)
+    if before_id:
+        query = query.filter(Vehicle.id < before_id)
+    listed_vehicles = query.order_by(Vehicle.id.desc()).limit(HOST_VEHICLES_PAGE_SIZE + 1).all()
+    next_before = listed_vehicles[HOST_VEHICLES_PAGE_SIZE - 1].id if len(listed_vehicles) > HOST_VEHICLES_PAGE_SIZE else None
+    listed_vehicles = listed_vehicles[:HOST_VEHICLES_PAGE_SIZE]
+
+    # Only count separately when the fleet doesn't fit on one page
+    if before_id or next_before:
+        listed_vehicle_count = Vehicle.query.filter_by(host_id=host_id).count()
+    else:
+        listed_vehicle_count = len(listed_vehicles)
+
+    confirmed_by_vehicle = defaultdict(list)
+    if listed_vehicles:
+        confirmed = Booking.query.filter(
+            Booking.vehicle_id.in_([v.id for v in listed_vehicles]),
+            Booking.status == 'Confirmed'
+        ).options(
+            load_only(Booking.id, Booking.vehicle_id, Booking.user_id, Booking.status, Booking.start_date, Booking.end_date),
+            joinedload(Booking.customer).load_only(User.id, User.first_name)
+        ).order_by(Booking.start_date.desc()).all()
+        for b in confirmed:
+            confirmed_by_vehicle[b.vehicle_id].append(b)
+
+    now = datetime.utcnow()
+    for vehicle in listed_vehicles:
+        bookings = confirmed_by_vehicle[vehicle.id]
+        # Attach as the loaded collection without marking it dirty (a plain assignment would
+        # detach the non-confirmed bookings from the vehicle on the next flush).
+        set_committed_value(vehicle, 'bookings', bookings)
+        vehicle.has_future_booking = any(b.end_date > now for b in bookings)
+    return listed_vehicles, next_before, listed_vehicle_count
+
+@app.route('/host/demand-widget')
+@host_required
+def host_demand_widget():
+    """The dashboard's Market Demand block as an HTML fragment; the browser keeps it for 10 minutes."""
+    user = current_user()
+    response = make_response(render_template('host_demand_widget.html', demand_insights=get_demand_insights(user.city)))
+    response.headers['Cache-Control'] = 'private, max-age=600'
+    response.headers['Vary'] = 'Cookie'
+    return response
+
 @app.route('/host/dashboard', methods=['GET', 'POST'])
 @host_required # <--- Now checks for role=='host' AND is_approved_host==True
 def host_dashboard():
     user_id = session.get('user_id')
-    user = User.query.get(user_id)
+    user = current_user()
     error = None
     
-    # 1. Get Demand Insights (NEW)
-    demand_insights = get_demand_insights(user.city)
+    # Demand insights are fetched by the page from /host/demand-widget (browser-cached), off this request's path
     
     # NEW: Initialize submitted_data to pass back to the template if there's an error (UX Improvement)
     submitted_data = {} 
@@ -1132,7 +2189,7 @@ def host_dashboard():
         sub_city_val = request.form.get('sub_city')
         
         if not error and sub_city_val:
-            if city_val not in SUB_CITY_MAP or sub_city_val not in SUB_CITY_MAP[city_val]:
+            if sub_city_val not in _SUB_CITIES.get((city_val or '').lower(), frozenset()):
                 error = f"Error: The selected sub-city '{sub_city_val}' is invalid for the chosen city '{city_val}'. Please select a valid location."
         
         # --- 3. Image Validation ---
@@ -1144,10 +2201,10 @@ def host_dashboard():
                     file = request.files['vehicle_image']
                     if file and allowed_file(file.filename):
                         filename = secure_filename(file.filename)
-                        vehicle_count = Vehicle.query.filter_by(host_id=user_id).count()
-                        unique_filename = f"{user.id}-{vehicle_count + 1}-{filename}"
+                        # Random suffix: no COUNT(*) round trip, and two concurrent uploads can't collide
+                        unique_filename = f"{user.id}-{secrets.token_hex(6)}-{filename}"
                         save_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                        file.save(save_path)
+                        save_upload(file, save_path)
                         image_url_to_db = url_for('static', filename=f'uploads/{unique_filename}')
                     elif not error:
                         error = "Invalid file type. Only JPG, PNG, WEBP allowed."
@@ -1157,44 +2214,26 @@ def host_dashboard():
 
         # --- Handle Errors ---
         if error:
-            listed_vehicles = Vehicle.query.filter_by(host_id=user_id).options(
-                joinedload(Vehicle.bookings).joinedload(Booking.customer)
-            ).all()
-            for vehicle in listed_vehicles:
-                vehicle.bookings = [b for b in vehicle.bookings if b.status == 'Confirmed']
+            listed_vehicles, next_before, listed_vehicle_count = host_listed_vehicles(user_id)
             # NEW: Pass submitted_data back to the template
             return render_template('host_vehicle_add.html', 
                                    error=error, 
                                    user=user, 
                                    listed_vehicles=listed_vehicles, 
-                                   sub_city_map_json=json.dumps(SUB_CITY_MAP),
-                                   submitted_data=submitted_data,
-                                   demand_insights=demand_insights) # ADDED INSIGHTS TO CONTEXT
+                                   next_before=next_before,
+                                   listed_vehicle_count=listed_vehicle_count,
+                                   submitted_data=submitted_data)
             
         
         # --- Final Save (Only if no errors) ---
         if not error:
             try:
-                # --- CRITICAL: Get PRECISE Geolocation Data using the full Host address as a reference ---
-                host_address_1 = user.address1
-                host_address_2 = user.address2
-                host_city = city_val # Use the City selected for the vehicle
-                host_state = user.state
-                host_pincode = user.pincode
-
-                # Call the precise Geocoding function
-                precise_loc = get_precise_lat_lng(
-                    address_line_1=host_address_1,
-                    address_line_2=host_address_2,
-                    city=host_city,
-                    state=host_state,
-                    pincode=host_pincode,
-                    api_key=app.config['GOOGLE_MAPS_API_KEY']
-                )
-                # ---------------------------------
+                # Start at the city center; the precise (Google) location is written behind, see below
+                host_city = city_val
+                base_lat, base_lng = _CITY_GEO.get((host_city or '').lower(), DEFAULT_GEO)
                 
-                vehicle_count = Vehicle.query.filter_by(host_id=user_id).count()
-                vehicle_id_code = f"{request.form.get('name').lower().replace(' ', '-')}-{request.form.get('city').lower()}-{user.id}-{vehicle_count + 1}"
+                # Unique suffix without counting the host's vehicles; the column's UNIQUE constraint backs it up
+                vehicle_id_code = f"{request.form.get('name').lower().replace(' ', '-')}-{request.form.get('city').lower()}-{user.id}-{secrets.token_hex(4)}"
                 
                 new_vehicle = Vehicle(
                     host_id=user.id,
@@ -1207,66 +2246,71 @@ def host_dashboard():
                     city=host_city,
                     sub_city=sub_city_val, 
                     # --- NEW PRECISE GEOLOCATION DATA INSERTION ---
-                    latitude=precise_loc['lat'],
-                    longitude=precise_loc['lng'],
+                    latitude=base_lat,
+                    longitude=base_lng,
                     # --------------------------------------
                     base_price=float(request.form.get('base_price')), 
                     image_url=image_url_to_db, 
                     kms_per_unit=int(request.form.get('kms_per_unit')),
-                    features=','.join(request.form.getlist('features')),
+                    features=request.form.getlist('features'),
                     # NEW: Get specification from form
                     specification=request.form.get('specification')
                 )
                 
                 db.session.add(new_vehicle)
+                # flush assigns the id; read what we need before commit expires the object
+                # (afterwards every attribute access would cost a refresh SELECT)
+                db.session.flush()
+                new_vehicle_id, new_vehicle_name = new_vehicle.id, new_vehicle.name
                 db.session.commit()
+                invalidate_inventory_cache()
+
+                # --- CRITICAL: PRECISE Geolocation using the full Host address as a reference (off the request thread) ---
+                geocode_vehicle_later(
+                    new_vehicle_id,
+                    address_line_1=user.address1,
+                    address_line_2=user.address2,
+                    city=host_city,
+                    state=user.state,
+                    pincode=user.pincode,
+                    api_key=app.config['GOOGLE_MAPS_API_KEY']
+                )
                 
-                flash(f"✅ Vehicle '{new_vehicle.name}' listed successfully!", 'success')
+                flash(f"✅ Vehicle '{new_vehicle_name}' listed successfully!", 'success')
                 return redirect(url_for('host_dashboard'))
 
             except Exception as e:
                 db.session.rollback()
+                if image_url_to_db:
+                    discard_upload(save_path) # the listing was never stored
                 print(f"Vehicle Add Error: {e}")
                 error = f"An unexpected database error occurred: {e}"
                 
                 # NEW: Pass submitted_data back if a late database error occurs
-                listed_vehicles = Vehicle.query.filter_by(host_id=user_id).options(joinedload(Vehicle.bookings).joinedload(Booking.customer)).all()
-                for vehicle in listed_vehicles:
-                    vehicle.bookings = [b for b in vehicle.bookings if b.status == 'Confirmed']
+                listed_vehicles, next_before, listed_vehicle_count = host_listed_vehicles(user_id)
                 return render_template('host_vehicle_add.html', 
                                        error=error, 
                                        user=user, 
                                        listed_vehicles=listed_vehicles, 
-                                       sub_city_map_json=json.dumps(SUB_CITY_MAP),
-                                       submitted_data=submitted_data,
-                                       demand_insights=demand_insights) # ADDED INSIGHTS TO CONTEXT
+                                       next_before=next_before,
+                                       listed_vehicle_count=listed_vehicle_count,
+                                       submitted_data=submitted_data)
 
     
     # --- GET Request (Initial Load) ---
-    listed_vehicles = Vehicle.query.filter_by(host_id=user_id).options(
-        joinedload(Vehicle.bookings).joinedload(Booking.customer)
-    ).order_by(Vehicle.id.desc()).all() 
-    
-    for vehicle in listed_vehicles:
-        # Filter for confirmed bookings for display
-        confirmed_bookings = [
-            b for b in vehicle.bookings if b.status == 'Confirmed' 
-        ]
-        vehicle.bookings = confirmed_bookings
-        
-        # NEW: Check for future bookings to enable/disable the edit button
-        future_booking = any(b.end_date > datetime.utcnow() for b in confirmed_bookings)
-        vehicle.has_future_booking = future_booking
+    listed_vehicles, next_before, listed_vehicle_count = host_listed_vehicles(
+        user_id, before_id=request.args.get('before', type=int)
+    )
 
     
     # When loading initially, submitted_data is empty
     return render_template('host_vehicle_add.html', 
                            user=user, 
                            listed_vehicles=listed_vehicles, 
+                           next_before=next_before,
+                           listed_vehicle_count=listed_vehicle_count,
                            error=error,
-                           sub_city_map_json=json.dumps(SUB_CITY_MAP),
-                           submitted_data={},
-                           demand_insights=demand_insights) # ADDED INSIGHTS TO CONTEXT
+                           submitted_data={})
 
 # --- NEW: ROUTE FOR EDITING A VEHICLE ---
 @app.route('/host/edit-vehicle/<int:vehicle_id>', methods=['GET', 'POST'])
@@ -1279,18 +2323,19 @@ def edit_vehicle(vehicle_id):
         flash("❌ Vehicle not found or you don't have permission to edit it.", 'error')
         return redirect(url_for('host_dashboard'))
 
-    # Security Check: Prevent editing if there's a future confirmed booking
-    future_booking = Booking.query.filter(
+    # Security Check: Prevent editing if there's a future confirmed booking (EXISTS: no row is fetched)
+    future_booking = db.session.query(exists().where(
         Booking.vehicle_id == vehicle_id,
         Booking.status == 'Confirmed',
         Booking.end_date > datetime.utcnow()
-    ).first()
+    )).scalar()
 
     if future_booking:
         flash(f"❌ Cannot edit '{vehicle.name}' as it has an upcoming booking.", 'error')
         return redirect(url_for('host_dashboard'))
 
     if request.method == 'POST':
+        old_image_path = new_image_path = None
         try:
             # Update basic details
             vehicle.name = request.form.get('name')
@@ -1300,37 +2345,37 @@ def edit_vehicle(vehicle_id):
             vehicle.gear = request.form.get('gear')
             vehicle.base_price = float(request.form.get('base_price'))
             vehicle.kms_per_unit = int(request.form.get('kms_per_unit'))
-            vehicle.features = ','.join(request.form.getlist('features'))
+            vehicle.features = request.form.getlist('features')
             vehicle.specification = request.form.get('specification')
 
             # Handle optional image upload
             if 'vehicle_image' in request.files:
                 file = request.files['vehicle_image']
                 if file.filename != '' and allowed_file(file.filename):
-                    # Delete old image if it exists
+                    # The old image is only removed once the new URL is committed (see below)
                     if vehicle.image_url:
-                        try:
-                            # Construct absolute path to the old file
-                            old_filename = vehicle.image_url.split('/')[-1]
-                            old_filepath = os.path.join(app.config['UPLOAD_FOLDER'], old_filename)
-                            if os.path.exists(old_filepath):
-                                os.remove(old_filepath)
-                        except Exception as e:
-                            print(f"Could not delete old image file: {e}")
+                        old_filename = vehicle.image_url.split('/')[-1]
+                        old_image_path = os.path.join(app.config['UPLOAD_FOLDER'], old_filename)
                     
                     # Save new image
                     filename = secure_filename(file.filename)
                     unique_filename = f"{user_id}-{vehicle.id}-{datetime.now().strftime('%Y%m%d%H%M%S')}-{filename}"
                     save_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(save_path)
+                    save_upload(file, save_path)
+                    new_image_path = save_path
                     vehicle.image_url = url_for('static', filename=f'uploads/{unique_filename}')
 
             db.session.commit()
+            invalidate_inventory_cache()
+            if old_image_path and old_image_path != new_image_path:
+                discard_upload_later(old_image_path) # nothing references it any more; don't make the host wait on the disk
             flash(f"✅ Vehicle '{vehicle.name}' updated successfully!", 'success')
             return redirect(url_for('host_dashboard'))
 
         except Exception as e:
             db.session.rollback()
+            if new_image_path:
+                discard_upload(new_image_path) # the row still points at the old image
             flash(f"❌ An error occurred while updating the vehicle: {e}", 'error')
             print(f"Vehicle Edit Error: {e}")
 
@@ -1350,20 +2395,22 @@ def toggle_availability(vehicle_id):
 
     # Check for future bookings ONLY if the host is trying to make it UNAVAILABLE
     if vehicle.is_available: # If it's currently available, check before disabling
-        future_booking = Booking.query.filter(
+        # Only the date the message needs, not a whole Booking row
+        future_booking_end = db.session.query(func.max(Booking.end_date)).filter(
             Booking.vehicle_id == vehicle_id,
             Booking.status == 'Confirmed',
             Booking.end_date > datetime.utcnow()
-        ).first()
+        ).scalar()
 
-        if future_booking:
-            flash(f"❌ Cannot make '{vehicle.name}' unavailable. It has a confirmed future booking ending on {future_booking.end_date.strftime('%Y-%m-%d %H:%M')}.", 'error')
+        if future_booking_end:
+            flash(f"❌ Cannot make '{vehicle.name}' unavailable. It has a confirmed future booking ending on {future_booking_end.strftime('%Y-%m-%d %H:%M')}.", 'error')
             return redirect(url_for('host_dashboard'))
     
     # If no future bookings or if re-enabling, proceed to toggle
     try:
         vehicle.is_available = not vehicle.is_available
         db.session.commit()
+        invalidate_inventory_cache()
         
         new_status = "Available" if vehicle.is_available else "Unavailable"
         flash(f"✅ Status for '{vehicle.name}' updated to {new_status}.", 'success')
@@ -1379,8 +2426,7 @@ def toggle_availability(vehicle_id):
 @app.route('/host/set-tier', methods=['GET', 'POST'])
 @host_required
 def set_host_tier():
-    user_id = session.get('user_id')
-    user = User.query.get(user_id)
+    user = current_user()
     
     # 80% tier ka rule: Host must be approved and active
     can_access_80_tier = user.is_approved_host and user.is_active and len(user.vehicles) >= 1
@@ -1395,6 +2441,7 @@ def set_host_tier():
         try:
             user.commission_tier = int(selected_tier)
             db.session.commit()
+            invalidate_admin_stats() # host payout figures depend on the tier
             flash(f"✅ Success! Your commission tier has been updated to {user.commission_tier}%.", 'success')
             return redirect(url_for('host_dashboard'))
         except ValueError:
@@ -1412,47 +2459,66 @@ def set_host_tier():
 # --------------------------------------------------
 
 # --- NEW ROUTE FOR HOST EARNINGS VIEW ---
+HOST_EARNINGS_PAGE_SIZE = 50
+
 @app.route('/host/earnings')
 @host_required
 def host_earnings_view():
     user_id = session.get('user_id')
-    user = User.query.get(user_id)
+    user = current_user()
     
     # Host's current payout rate (e.g., 0.70 or 0.80)
     payout_rate = (user.commission_tier / 100.0) if user and user.commission_tier else 0.70
     
-    # Fetch all confirmed bookings associated with this Host's vehicles
-    host_bookings = Booking.query.options(joinedload(Booking.vehicle_info)).join(Vehicle).filter(
-        Vehicle.host_id == user_id,
-        Booking.status == 'Confirmed'
-    ).order_by(Booking.start_date.desc()).all()
+    # The payout split is computed in SQL so the per-row figures and the lifetime total use the same rounding
+    confirmed_for_host = (Vehicle.host_id == user_id, Booking.status == 'Confirmed')
+    host_share_expr = func.round((Booking.total_price - Booking.deposit_amount) * payout_rate)
+
+    total_lifetime_earnings = db.session.query(func.coalesce(func.sum(host_share_expr), 0)).select_from(Booking).join(Vehicle).filter(
+        *confirmed_for_host
+    ).scalar()
+
+    # Only the columns the table shows (no ORM objects), one page at a time
+    query = db.session.query(
+        Booking.id, Vehicle.name, Booking.total_price, Booking.deposit_amount, Booking.start_date,
+        host_share_expr.label('host_share')
+    ).join(Vehicle).filter(*confirmed_for_host)
+
+    # Keyset pagination on (start_date, id), same as My Bookings: "?before=<booking id>"
+    before_id = request.args.get('before', type=int)
+    if before_id:
+        cursor_start = db.session.query(Booking.start_date).filter_by(id=before_id).scalar_subquery()
+        query = query.filter(or_(
+            Booking.start_date < cursor_start,
+            and_(Booking.start_date == cursor_start, Booking.id < before_id)
+        ))
+    host_bookings = query.order_by(Booking.start_date.desc(), Booking.id.desc()).limit(HOST_EARNINGS_PAGE_SIZE + 1).all()
+    next_before = host_bookings[HOST_EARNINGS_PAGE_SIZE - 1].id if len(host_bookings) > HOST_EARNINGS_PAGE_SIZE else None
+    host_bookings = host_bookings[:HOST_EARNINGS_PAGE_SIZE]
     
     earnings_summary = []
-    total_lifetime_earnings = 0
-    
-    for booking in host_bookings:
-        # Calculate commissionable base (Total Price - Deposit)
-        commissionable_base = booking.total_price - booking.deposit_amount
-        
-        host_share = round(commissionable_base * payout_rate)
+    for row in host_bookings:
+        # Commissionable base is Total Price - Deposit; the platform keeps what the host doesn't
+        commissionable_base = row.total_price - row.deposit_amount
+        host_share = row.host_share
         platform_commission = round(commissionable_base - host_share)
         
         earnings_summary.append({
-            'booking_id': booking.id,
-            'vehicle_name': booking.vehicle_info.name,
-            'total_booked_price': round(booking.total_price),
-            'deposit_amount': round(booking.deposit_amount), # NEW
+            'booking_id': row.id,
+            'vehicle_name': row.name,
+            'total_booked_price': round(row.total_price),
+            'deposit_amount': round(row.deposit_amount), # NEW
             'host_earning': host_share,
             'platform_commission': platform_commission,
-            'start_date': booking.start_date.strftime('%Y-%m-%d %H:%M'),
+            'start_date': row.start_date.strftime('%Y-%m-%d %H:%M'),
         })
-        total_lifetime_earnings += host_share
         
     context = {
         'user': user,
         'payout_rate': round(payout_rate * 100),
         'total_lifetime_earnings': round(total_lifetime_earnings),
         'earnings_summary': earnings_summary,
+        'next_before': next_before,
     }
     
     return render_template('host_earnings.html', **context)
@@ -1475,17 +2541,27 @@ def host_success():
 # === ROUTES (ADMIN ACTIONS) ===
 # ==================================
 
+ADMIN_LIST_PAGE_SIZE = 50
+
 # --- ADDED: ADMIN USERS ROUTE (Fix for BuildError) ---
 @app.route('/admin/users', methods=['GET'])
 @admin_required
 def admin_users():
     """Displays a sortable/filterable list of all Users (Hosts and Customers)."""
-    # Fetch all users who are not super_admin
-    all_users = User.query.filter(User.role != 'super_admin').order_by(User.id.desc()).all()
+    before_id = request.args.get('before', type=int)
+
+    # Fetch users who are not super_admin, newest first, one page at a time.
+    # Keyset pagination on id: "?before=<user id>" continues after that user
+    query = User.query.filter(User.role != 'super_admin')
+    user_count = query.order_by(None).count()
+    if before_id:
+        query = query.filter(User.id < before_id)
+    all_users = query.order_by(User.id.desc()).limit(ADMIN_LIST_PAGE_SIZE + 1).all()
+    next_before = all_users[ADMIN_LIST_PAGE_SIZE - 1].id if len(all_users) > ADMIN_LIST_PAGE_SIZE else None
+    all_users = all_users[:ADMIN_LIST_PAGE_SIZE]
     
-    # For User List page, we pass all users
     # NOTE: You will need an admin_user_list.html template for this.
-    return render_template('admin_user_list.html', all_users=all_users) 
+    return render_template('admin_user_list.html', all_users=all_users, user_count=user_count, next_before=next_before) 
 
 # --- NEW: ADMIN COMPLAINTS ROUTE ---
 @app.route('/admin/complaints', methods=['GET'])
@@ -1494,18 +2570,29 @@ def admin_complaints():
     """Displays a sortable/filterable list of all submitted complaints."""
     # Get the status filter from the query parameters, default to 'New'
     status_filter = request.args.get('status', 'New')
+    before_id = request.args.get('before', type=int)
 
     query = Complaint.query
     
     if status_filter and status_filter != 'All':
         query = query.filter(Complaint.status == status_filter)
 
-    all_complaints = query.order_by(Complaint.submitted_at.desc()).all()
+    # Keyset pagination on (submitted_at, id): "?before=<complaint id>" continues after that complaint
+    if before_id:
+        cursor_at = db.session.query(Complaint.submitted_at).filter_by(id=before_id).scalar_subquery()
+        query = query.filter(or_(
+            Complaint.submitted_at < cursor_at,
+            and_(Complaint.submitted_at == cursor_at, Complaint.id < before_id)
+        ))
+    all_complaints = query.order_by(Complaint.submitted_at.desc(), Complaint.id.desc()).limit(ADMIN_LIST_PAGE_SIZE + 1).all()
+    next_before = all_complaints[ADMIN_LIST_PAGE_SIZE - 1].id if len(all_complaints) > ADMIN_LIST_PAGE_SIZE else None
+    all_complaints = all_complaints[:ADMIN_LIST_PAGE_SIZE]
     
     # NOTE: You will need a new admin_complaints.html template for this.
     return render_template('admin_complaints.html', 
                              complaints=all_complaints, 
-                             current_filter=status_filter)
+                             current_filter=status_filter,
+                             next_before=next_before)
 # ----------------------------------------------------
 
 # --- ADDED: ADMIN USER PROFILE ROUTE ---
@@ -1520,20 +2607,27 @@ def view_user_profile(user_id):
         flash("❌ Error: User or Host profile not found.", 'error')
         return redirect(url_for('admin_users'))
         
-    # Fetch all confirmed bookings where this user is either the customer or the host
-    bookings = Booking.query.options(joinedload(Booking.vehicle_info)).filter(
-        (Booking.user_id == user_id) | (Vehicle.host_id == user_id)
-    ).join(Vehicle, Booking.vehicle_id == Vehicle.id).order_by(Booking.start_date.desc()).all()
+    # Bookings where this user is the customer, plus bookings on their vehicles. Two index seeks
+    # glued with UNION ALL instead of one OR across the join; own-vehicle bookings are excluded
+    # from the host side so they are not listed twice.
+    customer_bookings = Booking.query.filter(Booking.user_id == user_id)
+    host_bookings = Booking.query.join(Vehicle, Booking.vehicle_id == Vehicle.id).filter(
+        Vehicle.host_id == user_id, Booking.user_id != user_id
+    )
+    bookings = customer_bookings.union_all(host_bookings).options(
+        selectinload(Booking.vehicle_info)
+    ).order_by(Booking.start_date.desc()).all()
 
     # Calculate Host Earnings (if user is a host)
     host_earnings = 0
     if user.role == 'host':
-        confirmed_host_bookings = Booking.query.join(Vehicle).filter(
+        # Using 80% Host share based on default commission calculation; summed by the database
+        host_earnings = db.session.query(
+            func.coalesce(func.sum((Booking.total_price - Booking.deposit_amount) * 0.80), 0.0)
+        ).select_from(Booking).join(Vehicle, Booking.vehicle_id == Vehicle.id).filter(
             Vehicle.host_id == user_id,
             Booking.status == 'Confirmed'
-        ).all()
-        # Using 80% Host share based on default commission calculation
-        host_earnings = sum((b.total_price - b.deposit_amount) * 0.80 for b in confirmed_host_bookings)
+        ).scalar()
 
 
     context = {
@@ -1547,38 +2641,142 @@ def view_user_profile(user_id):
 # --------------------------------------------------------------------
 
 
+# --- NEW: CACHED PLATFORM STATS FOR THE ADMIN DASHBOARD ---
+ADMIN_STATS_CACHE_KEY = 'primedrew:admin:stats:v1'
+ADMIN_STATS_TTL = 30 # seconds; the headline numbers tolerate brief staleness
+
+def invalidate_admin_stats():
+    cache_delete(ADMIN_STATS_CACHE_KEY)
+
+def admin_platform_stats():
+    """
+    The admin dashboard's whole-table aggregates (booking counters, revenue, host payouts).
+    Cached in Redis for ADMIN_STATS_TTL and dropped when a booking is confirmed/cancelled or a tier changes;
+    the actionable queues (refunds, pending hosts) are always read live.
+    """
+    cached = cache_get(ADMIN_STATS_CACHE_KEY)
+    if cached is not None:
+        return orjson.loads(cached)
+    stats = _compute_admin_platform_stats()
+    cache_set(ADMIN_STATS_CACHE_KEY, orjson.dumps(stats), ADMIN_STATS_TTL)
+    return stats
+
+def _compute_admin_platform_stats():
+    # 1. Booking Stats & Revenue
+    # Confirmed bookings rolled up per host in the database: one row per host instead of one object per booking
+    host_rollup = db.session.query(
+        User.id, User.first_name, User.role, User.commission_tier,
+        func.sum(Booking.total_price - Booking.deposit_amount).label('commissionable_base'),
+        func.count(Booking.id).label('booking_count')
+    ).join(Vehicle, Vehicle.host_id == User.id).join(Booking, Booking.vehicle_id == Vehicle.id).filter(
+        Booking.status == 'Confirmed'
+    ).group_by(User.id, User.first_name, User.role, User.commission_tier).all()
+    
+    # 2. Headline counters (bookings, confirmed, revenue, hosts, vehicles) in a single round trip
+    is_confirmed = Booking.status == 'Confirmed'
+    stats = db.session.execute(select(
+        func.count(Booking.id).label('total_bookings'),
+        func.coalesce(func.sum(case((is_confirmed, 1), else_=0)), 0).label('confirmed'),
+        func.coalesce(func.sum(case((is_confirmed, Booking.total_price), else_=0)), 0).label('revenue'),
+        select(func.count(User.id)).where(User.role == 'host').scalar_subquery().label('hosts'),
+        select(func.count(Vehicle.id)).scalar_subquery().label('vehicles')
+    )).one()
+
+    total_bookings_count = stats.total_bookings
+    confirmed_count = stats.confirmed
+    total_revenue = stats.revenue
+    total_hosts = stats.hosts
+    total_vehicles = stats.vehicles
+    
+    # 3. Host Booking Overview: top 10 host names by confirmed bookings, folded from the per-host
+    # rollup above rather than a second GROUP BY over the same join
+    bookings_by_name = defaultdict(int)
+    for row in host_rollup:
+        if row.role == 'host':
+            bookings_by_name[row.first_name] += row.booking_count
+    host_booking_summary = sorted(bookings_by_name.items(), key=lambda item: item[1], reverse=True)[:10]
+
+    
+    # 4. FINANCIAL HEALTH CALCULATION (Updated to exclude deposit from commission)
+    total_platform_commission = 0
+    total_payout_due = 0
+    host_financial_summary = {}
+
+    for row in host_rollup:
+        payout_rate = (row.commission_tier / 100.0) if row.commission_tier else 0.70
+        
+        # Commissionable base (Total Price - Deposit), already summed per host
+        commission = row.commissionable_base * (1.0 - payout_rate) 
+        payout = row.commissionable_base * payout_rate      
+        
+        total_platform_commission += commission
+        total_payout_due += payout
+
+        host_financial_summary[row.id] = {
+            'name': row.first_name,
+            'total_earnings': payout,
+            'total_bookings': row.booking_count,
+            'tier': row.commission_tier
+        }
+
+    host_payouts_list = sorted(
+        host_financial_summary.values(), 
+        key=lambda x: x['total_earnings'], 
+        reverse=True
+    )
+
+    return {
+        'total_bookings': total_bookings_count,
+        'confirmed_bookings_count': confirmed_count,
+        'total_revenue': round(total_revenue),
+        'total_hosts': total_hosts,
+        'total_vehicles': total_vehicles,
+        'host_booking_summary': [list(row) for row in host_booking_summary],
+        # NEW FINANCIAL CONTEXT
+        'total_platform_commission': round(total_platform_commission),
+        'total_payout_due': round(total_payout_due),
+        'host_payouts_list': host_payouts_list
+    }
+# ----------------------------------------------------------
+
 @app.route('/admin')
 @admin_required
 def admin_dashboard():
     # --- Data for Admin Panel ---
     
-    # 1. Booking Stats & Revenue
-    confirmed_bookings = Booking.query.filter_by(status='Confirmed').all()
-    
-    total_bookings_count = Booking.query.count()
-    confirmed_count = len(confirmed_bookings)
-
-    total_revenue = sum(b.total_price for b in confirmed_bookings)
-    
-    # 2. Host and Vehicle Data
-    total_hosts = db.session.query(User).filter_by(role='host').count()
-    total_vehicles = db.session.query(Vehicle).count()
+    # 1-2. Platform-wide counters and financials (whole-table aggregates, cached briefly)
+    stats = admin_platform_stats()
     
     # 3. Detailed Cancelled/Refund Request View (Now filtered by refund_status='Pending')
     # This remains for the main booking refund flow (Cancellation/Fee)
-    pending_booking_refunds = Booking.query.options(
-        joinedload(Booking.customer),
-        joinedload(Booking.vehicle_info).joinedload(Vehicle.host)
-    ).filter(
-        Booking.status == 'Cancelled',
-        Booking.refund_status == 'Pending'
-    ).all()
+    # The fee is the one cancel_booking stored on the row; the refund due is derived from it in the
+    # SELECT itself, so each row arrives ready to render
+    host = aliased(User)
+    cancellation_fee = func.coalesce(Booking.cancellation_fee, 0)
+    cancelled_details = db.session.execute(
+        select(
+            Booking.id.label('booking_id'),
+            func.coalesce(User.first_name + ' ' + User.last_name, 'N/A').label('customer_name'),
+            func.coalesce(Vehicle.name, 'N/A').label('vehicle_name'),
+            func.coalesce(host.first_name, 'N/A').label('vehicle_host'),
+            cast(func.round(Booking.total_price), Integer).label('total_price'),
+            cast(func.round(Booking.total_price - cancellation_fee), Integer).label('refund_due'),
+            cancellation_fee.label('cancellation_fee'),
+            Booking.payment_id,
+            Booking.booked_at,
+        )
+        .outerjoin(User, Booking.user_id == User.id)
+        .outerjoin(Vehicle, Booking.vehicle_id == Vehicle.id)
+        .outerjoin(host, Vehicle.host_id == host.id)
+        .where(Booking.status == 'Cancelled', Booking.refund_status == 'Pending')
+    ).mappings().all()
     
     # --- NEW: Deposit Refund Requests ---
     # This covers completed bookings where deposit refund is pending
+    # The deposit table only shows the customer's first name and the vehicle name, never the host
     pending_deposit_refunds = Booking.query.options(
-            joinedload(Booking.customer),
-            joinedload(Booking.vehicle_info).joinedload(Vehicle.host)
+        joinedload(Booking.customer).load_only(User.id, User.first_name),
+        joinedload(Booking.vehicle_info).load_only(Vehicle.id, Vehicle.name)
     ).filter(
         Booking.end_date < datetime.utcnow(),
         Booking.status == 'Confirmed',
@@ -1586,32 +2784,7 @@ def admin_dashboard():
     ).all()
     # -----------------------------------
     
-    cancelled_details = []
-    for booking in pending_booking_refunds:
-        user = booking.customer
-        vehicle = booking.vehicle_info
-        
-        cancellation_fee = 0
-        refund_amount = booking.total_price
-        time_difference = datetime.utcnow() - booking.booked_at
-        
-        if time_difference >= timedelta(hours=1):
-            cancellation_fee = round(booking.total_price * 0.10) 
-            refund_amount = booking.total_price - cancellation_fee
-            
-        cancelled_details.append({
-            'booking_id': booking.id,
-            'customer_name': f"{user.first_name} {user.last_name}" if user else 'N/A',
-            'vehicle_name': vehicle.name if vehicle else 'N/A',
-            'vehicle_host': vehicle.host.first_name if vehicle and vehicle.host else 'N/A',
-            'total_price': round(booking.total_price),
-            'refund_due': round(refund_amount),
-            'cancellation_fee': cancellation_fee,
-            'payment_id': booking.payment_id,
-            'booked_at': booking.booked_at.strftime('%Y-%m-%d %H:%M')
-        })
-    
-    cancelled_count = len(pending_booking_refunds) # Count only pending booking refunds for dashboard stat
+    cancelled_count = len(cancelled_details) # Count only pending booking refunds for dashboard stat
     deposit_refund_count = len(pending_deposit_refunds) # NEW stat
 
     # 4. Host Approval Overview (NEW)
@@ -1620,81 +2793,19 @@ def admin_dashboard():
         User.is_approved_host == False
     ).order_by(User.id.asc()).all()
     
-    # 5. All Hosts for Blocking/Activating (NOTE: Moved to admin_users for clarity)
-    all_hosts = db.session.query(User).filter(
-        User.role == 'host',
-    ).order_by(User.id.desc()).all()
-
-
-    # 6. Host Booking Overview 
-    host_booking_summary = db.session.query(
-        User.first_name, 
-        db.func.count(Booking.id)
-    ).join(Vehicle, User.id == Vehicle.host_id).join(
-        Booking, Vehicle.id == Booking.vehicle_id
-    ).filter(
-        User.role == 'host',
-        Booking.status == 'Confirmed'
-    ).group_by(User.first_name).order_by(db.func.count(Booking.id).desc()).limit(10).all()
-
-    
-    # 7. FINANCIAL HEALTH CALCULATION (Updated to exclude deposit from commission)
-    total_platform_commission = 0
-    total_payout_due = 0
-    host_financial_summary = {}
+    # 5. Blocking/Activating hosts lives on the paginated admin_users page
 
-    for booking in confirmed_bookings:
-        host = booking.vehicle_info.host
-        
-        payout_rate = (host.commission_tier / 100.0) if host and host.commission_tier else 0.70
-        
-        # Calculate commissionable base (Total Price - Deposit)
-        commissionable_base = booking.total_price - booking.deposit_amount
-        
-        commission = commissionable_base * (1.0 - payout_rate) 
-        payout = commissionable_base * payout_rate      
-        
-        total_platform_commission += commission
-        total_payout_due += payout
-        
-        host_id = host.id
-        host_name = host.first_name
-
-        if host_id not in host_financial_summary:
-            host_financial_summary[host_id] = {
-                'name': host_name,
-                'total_earnings': 0,
-                'total_bookings': 0,
-                'tier': host.commission_tier
-            }
-        host_financial_summary[host_id]['total_earnings'] += payout
-        host_financial_summary[host_id]['total_bookings'] += 1
 
-    host_payouts_list = sorted(
-        host_financial_summary.values(), 
-        key=lambda x: x['total_earnings'], 
-        reverse=True
-    )
     # ========================================================
 
 
     context = {
-        'total_bookings': total_bookings_count,
-        'confirmed_bookings_count': confirmed_count,
+        **stats, # totals, revenue, host booking overview and the financial summary
         'cancelled_bookings_count': cancelled_count, # Pending booking refunds count
         'deposit_refund_count': deposit_refund_count, # NEW
-        'total_revenue': round(total_revenue),
-        'total_hosts': total_hosts,
-        'total_vehicles': total_vehicles,
         'cancelled_details': cancelled_details,
         'pending_deposit_refunds': pending_deposit_refunds, # NEW
-        'host_booking_summary': host_booking_summary,
         'pending_hosts': pending_hosts, 
-        'all_hosts': all_hosts, 
-        # NEW FINANCIAL CONTEXT
-        'total_platform_commission': round(total_platform_commission),
-        'total_payout_due': round(total_payout_due),
-        'host_payouts_list': host_payouts_list
     }
     
     return render_template('admin_dashboard.html', **context)
@@ -1716,19 +2827,23 @@ def toggle_host_status(user_id):
         user.is_active = new_status
         
         # --- CRITICAL: Deactivate ALL vehicles if Host is Blocked ---
-        vehicle_count = len(user.vehicles)
         if not new_status:
-            # Blocked: Set all host vehicles to is_available=False
-            for vehicle in user.vehicles:
-                vehicle.is_available = False
+            # Blocked: one UPDATE for the whole fleet instead of loading and flushing each vehicle
+            vehicle_count = db.session.query(func.count(Vehicle.id)).filter(Vehicle.host_id == user.id).scalar()
+            db.session.query(Vehicle).filter(Vehicle.host_id == user.id).update(
+                {Vehicle.is_available: False}, synchronize_session=False
+            )
             flash(f"⚠️ Host '{user.first_name}' blocked. All {vehicle_count} associated vehicles are now unavailable.", 'warning')
         elif new_status:
             # Activated: Do NOT automatically activate vehicles; Host must do this.
             flash(f"✅ Host '{user.first_name}' activated. Host must manually re-activate their vehicles.", 'success')
 
+        phone, email = user.phone, user.email
         db.session.commit()
+        invalidate_inventory_cache()
+        invalidate_user_cache(phone, email) # a blocked host must not log in from a cached record
 
-        action = "activated" if user.is_active else "blocked"
+        action = "activated" if new_status else "blocked"
         
         # Return a simple success message, Flash will show the details on reload
         return jsonify({'success': True, 'message': f"Host successfully {action}. Reloading dashboard..."}), 200
@@ -1831,17 +2946,17 @@ def approve_host_api(user_id):
         return jsonify({'success': False, 'message': f'Host {user.first_name} is currently blocked. Activate the account before approval.'}), 400
 
     try:
-        # 1. Update DB Status
+        # 1. Update DB Status (fields read first, so nothing reloads the row after commit)
+        phone, email, first_name, last_name = user.phone, user.email, user.first_name, user.last_name
         user.is_approved_host = True
-        
-        # 2. Try to Send SMS (This often causes failure if Twilio setup is incomplete/incorrect)
-        send_success = send_approval_sms(user.phone, user.first_name)
-        sms_message = "SMS triggered." if send_success else "WARNING: SMS failed to send (Check phone number format/Twilio credits)."
-        
-        # 3. Commit the DB change only if the update attempt was successful
         db.session.commit()
+        invalidate_user_cache(phone, email)
+        
+        # 2. Queue the SMS in the background; failures are logged on the server console
+        send_approval_sms_async(phone, first_name)
+        sms_message = "SMS queued."
         
-        flash(f"✅ Host '{user.first_name} {user.last_name}' successfully approved and can now list vehicles. {sms_message}", 'success')
+        flash(f"✅ Host '{first_name} {last_name}' successfully approved and can now list vehicles. {sms_message}", 'success')
         return jsonify({'success': True, 'message': f'Host approved successfully. {sms_message}'}), 200
         
     except Exception as e:
@@ -1874,30 +2989,31 @@ def submit_review():
         if not booking or not is_booking_reviewable(booking):
             return jsonify({'success': False, 'message': 'Booking not found or not eligible for review.'}), 403
 
+        new_rating = float(rating)
+
         # 1. Create the new Review object
         new_review = Review(
             booking_id=booking.id,
             user_id=user_id,
             vehicle_id=booking.vehicle_id,
-            rating=float(rating),
+            rating=new_rating,
             comment=comment
         )
         db.session.add(new_review)
-        db.session.commit()
 
-        # 2. Recalculate Vehicle's Average Rating
-        vehicle = Vehicle.query.get(booking.vehicle_id)
-        if vehicle:
-            # Fetch all existing reviews for this vehicle
-            all_reviews = Review.query.filter_by(vehicle_id=vehicle.id).all()
-            
-            total_rating = sum(r.rating for r in all_reviews)
-            # Default to 4.0 if somehow no reviews exist after this one (shouldn't happen)
-            new_avg_rating = total_rating / len(all_reviews) if all_reviews else 4.0 
-            
-            # Update the vehicle's rating (rounding to 1 decimal)
-            vehicle.rating = round(new_avg_rating, 1)
-            db.session.commit()
+        # 2. Update the Vehicle's running totals and average in one UPDATE (the other reviews are never read);
+        # SET expressions see the pre-update values, so concurrent reviews can't lose each other's counts
+        db.session.execute(
+            update(Vehicle).where(Vehicle.id == booking.vehicle_id).values(
+                rating_count=Vehicle.rating_count + 1,
+                rating_sum=Vehicle.rating_sum + new_rating,
+                rating=func.round(cast((Vehicle.rating_sum + new_rating) / (Vehicle.rating_count + 1), Numeric), 1) # Rounded to 1 decimal
+            ),
+            execution_options={'synchronize_session': False}
+        )
+        # One commit for both: the review and the vehicle totals land together or not at all
+        db.session.commit()
+        invalidate_inventory_cache()
 
         # Flash message for the user's next page load
         flash("⭐ Thank you! Your review has been submitted and the vehicle's rating updated.", 'success')
@@ -1911,31 +3027,99 @@ def submit_review():
         return jsonify({'success': False, 'message': f'Server error: {e}'}), 500
 
 
-@app.route('/api/inventory', methods=['GET'])
-def get_inventory():
-    # ... (Function body remains the same) ...
-    all_confirmed_bookings = Booking.query.filter_by(status='Confirmed').all()
-    
+INVENTORY_MAX_PAGE_SIZE = 200
+
+# The unfiltered listing (embedded by /search and served by a bare /api/inventory) is cached as a
+# ready-made JSON string; vehicle and booking writes call invalidate_inventory_cache().
+INVENTORY_CACHE_KEY = 'primedrew:inventory:v1'
+INVENTORY_CACHE_TTL = 60 # seconds
+
+def invalidate_inventory_cache():
+    cache_delete(INVENTORY_CACHE_KEY)
+
+def booked_dates_by_vehicle(vehicle_ids=None):
+    """
+    {vehicle_id: [[start, end], ...]} for confirmed bookings of available vehicles that haven't ended yet
+    (the search page only uses these ranges for overlap checks). Optionally limited to vehicle_ids.
+    """
+    query = db.session.query(Booking.vehicle_id, Booking.start_date, Booking.end_date).join(
+        Vehicle, Vehicle.id == Booking.vehicle_id
+    ).filter(
+        Booking.status == 'Confirmed',
+        Booking.end_date > datetime.utcnow(),
+        Vehicle.is_available == True
+    )
+    if vehicle_ids is not None:
+        if not vehicle_ids:
+            return {}
+        query = query.filter(Booking.vehicle_id.in_(vehicle_ids))
     booked_dates_map = {}
-    for booking in all_confirmed_bookings:
-        if booking.vehicle_id not in booked_dates_map:
-            booked_dates_map[booking.vehicle_id] = []
-        booked_dates_map[booking.vehicle_id].append([
-            booking.start_date.strftime('%Y-%m-%d %H:%M'), 
-            booking.end_date.strftime('%Y-%m-%d %H:%M')
+    for vehicle_id, start_date, end_date in query:
+        booked_dates_map.setdefault(vehicle_id, []).append([
+            start_date.strftime('%Y-%m-%d %H:%M'), 
+            end_date.strftime('%Y-%m-%d %H:%M')
         ])
-    
-    # Filter only available vehicles
-    db_vehicles = Vehicle.query.filter_by(is_available=True).all()
-    db_inventory_data = []
-    for vehicle in db_vehicles:
-        booked_info = booked_dates_map.get(vehicle.id, [])
-        # Fetch rating directly from the Vehicle object and export lat/lng via to_dict
-        db_inventory_data.append(vehicle.to_dict(booked_dates=booked_info))
-    
-    full_inventory = db_inventory_data 
+    return booked_dates_map
+
+def inventory_json():
+    """The full available inventory as a JSON string, served from the cache when possible."""
+    cached = cache_get(INVENTORY_CACHE_KEY)
+    if cached is not None:
+        return cached.decode()
+    booked_dates_map = booked_dates_by_vehicle()
+    vehicles = db.session.execute(select(*VEHICLE_LISTING_COLUMNS).where(Vehicle.is_available == True)).all()
+    payload = orjson.dumps(listing_payload(vehicles, booked_dates_map))
+    cache_set(INVENTORY_CACHE_KEY, payload, INVENTORY_CACHE_TTL)
+    return payload.decode()
+
+@app.route('/api/inventory', methods=['GET'])
+def get_inventory():
+    if not request.args:
+        response = app.response_class(inventory_json(), mimetype='application/json')
+        # Same for every visitor; booking still re-checks availability server-side
+        response.headers['Cache-Control'] = 'public, max-age=15'
+        return response
+
+    # Filter only available vehicles (Core select: plain rows, no ORM hydration)
+    stmt = select(*VEHICLE_LISTING_COLUMNS).where(Vehicle.is_available == True)
+
+    # Optional keyset pagination: ?limit=N[&after=<last db_id>]. Without it the full list is returned.
+    limit = request.args.get('limit', type=int)
+    if limit:
+        limit = max(1, min(limit, INVENTORY_MAX_PAGE_SIZE))
+        after = request.args.get('after', 0, type=int)
+        stmt = stmt.where(Vehicle.id > after).order_by(Vehicle.id).limit(limit)
+    db_vehicles = db.session.execute(stmt).all()
+
+    # The cursor follows the rows scanned, not the ones left after the date filter below:
+    # a page whose vehicles are all booked still has a next page
+    next_after = db_vehicles[-1].id if limit and len(db_vehicles) == limit else None
+
+    # Optional ?start=...&end=... drops vehicles already booked in that window (one query for all vehicles)
+    start_str, end_str = request.args.get('start'), request.args.get('end')
+    if start_str and end_str:
+        try:
+            start_dt = datetime.fromisoformat(start_str.replace('T', ' ', 1))
+            end_dt = datetime.fromisoformat(end_str.replace('T', ' ', 1))
+            # Bookings are stored naive; an offset would make the overlap comparison meaningless
+            if start_dt.tzinfo is not None or end_dt.tzinfo is not None:
+                raise ValueError("start/end must not carry a UTC offset")
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Invalid start/end date.'}), 400
+        booked_ids = unavailable_vehicle_ids([v.id for v in db_vehicles], start_dt, end_dt)
+        db_vehicles = [v for v in db_vehicles if v.id not in booked_ids]
+
+    # Booked ranges only for the vehicles actually being returned
+    booked_dates_map = booked_dates_by_vehicle([v.id for v in db_vehicles])
 
-    return jsonify(full_inventory)
+    # Rating and lat/lng come straight from the selected columns
+    full_inventory = listing_payload(db_vehicles, booked_dates_map)
+
+    response = jsonify(full_inventory)
+    if next_after is not None:
+        # Cursor for the next page; absent on the last page
+        response.headers['X-Next-After'] = str(next_after)
+    return response
 
 # --- MODIFIED RAZORPAY ORDER CREATION ROUTE ---
 @app.route('/api/create_razorpay_order', methods=['POST']) 
@@ -1944,7 +3128,7 @@ def create_razorpay_order():
     # ... (Function body remains the same) ...
     data = request.get_json()
     user_id = session.get('user_id')
-    user_details = User.query.get(user_id) # Fetch user for prefill details
+    user_details = current_user() # Fetch user for prefill details
     
     vehicle_id_code = data.get('vehicle_id') 
     start_date_str_iso = data.get('start_date')
@@ -1958,13 +3142,16 @@ def create_razorpay_order():
     if not vehicle:
         return jsonify({'success': False, 'message': 'Vehicle not found.'}), 404
         
+    # --- Date calculation for pricing/deposit
+    try:
+        s = parse_booking_datetime(start_date_str_iso)
+        e = parse_booking_datetime(end_date_str_iso)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid booking dates.'}), 400
+
     if not is_vehicle_available(vehicle.id, start_date_str_iso, end_date_str_iso):
         return jsonify({'success': False, 'message': 'Vehicle is booked for these times.'}), 409
         
-    # --- Date calculation for pricing/deposit
-    DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
-    s = datetime.strptime(start_date_str_iso, DATE_FORMAT)
-    e = datetime.strptime(end_date_str_iso, DATE_FORMAT)
     time_difference = e - s
     total_hours = time_difference.total_seconds() / 3600
 
@@ -1981,8 +3168,8 @@ def create_razorpay_order():
     # Razorpay amount is in paise (cents), so multiply by 100 and cast to int
     amount_in_paise = int(round(server_total_final * 100))
     
-    # Store temporary booking data in session to be used in the verification step
-    session['temp_booking_data'] = {
+    # Temporary booking data for the verification step (stored in the session once the order exists)
+    temp_booking_data = {
         'vehicle_id_code': vehicle_id_code,
         'start_date': start_date_str_iso,
         'end_date': end_date_str_iso,
@@ -1999,7 +3186,10 @@ def create_razorpay_order():
             'payment_capture': '1' # Auto capture payment
         }
         
-        razorpay_order = app.config['RZP_CLIENT'].order.create(data=order_data)
+        razorpay_order = rzp_client().order.create(data=order_data)
+        # The order carries the server-computed amount, so a signature over this order id proves the price
+        temp_booking_data['order_id'] = razorpay_order['id']
+        session['temp_booking_data'] = temp_booking_data
 
         return jsonify({
             'success': True, 
@@ -2027,6 +3217,7 @@ def confirm_booking():
     
     payment_id = data.get('payment_id') 
     razorpay_order_id = data.get('razorpay_order_id')
+    razorpay_signature = data.get('razorpay_signature')
 
     if not temp_data:
         return jsonify({'success': False, 'message': 'Session expired or order was not initialized.'}), 400
@@ -2042,29 +3233,48 @@ def confirm_booking():
 
     # --- CRITICAL: Verify Payment with Razorpay (using Secret Key on the server) ---
     try:
-        payment_details = app.config['RZP_CLIENT'].payment.fetch(payment_id)
-        
-        expected_amount_paise = int(expected_total_price * 100)
-        
-        if payment_details['order_id'] != razorpay_order_id:
-            raise ValueError("Order ID mismatch.")
+        # Checkout signs order_id|payment_id with our key secret: checking that HMAC locally proves the
+        # payment belongs to the order we created (and therefore to its amount) without a network call
+        signature_verified = False
+        if razorpay_signature and razorpay_order_id == temp_data.get('order_id'):
+            try:
+                rzp_client().utility.verify_payment_signature({
+                    'razorpay_order_id': razorpay_order_id,
+                    'razorpay_payment_id': payment_id,
+                    'razorpay_signature': razorpay_signature,
+                })
+                signature_verified = True
+            except razorpay.errors.SignatureVerificationError:
+                print(f"⚠️ Razorpay signature mismatch for payment {payment_id}; checking with the API.")
+
+        # Fallback (no signature, or a session from before order ids were stored): ask Razorpay directly
+        if not signature_verified:
+            payment_details = rzp_client().payment.fetch(payment_id)
+            
+            expected_amount_paise = int(expected_total_price * 100)
             
-        if payment_details['amount'] != expected_amount_paise or payment_details['status'] != 'captured':
-            raise ValueError(f"Payment validation failed. Amount: {payment_details['amount']}, Status: {payment_details['status']}")
+            if payment_details['order_id'] != razorpay_order_id:
+                raise ValueError("Order ID mismatch.")
+                
+            if payment_details['amount'] != expected_amount_paise or payment_details['status'] != 'captured':
+                raise ValueError(f"Payment validation failed. Amount: {payment_details['amount']}, Status: {payment_details['status']}")
 
     except Exception as e:
         print(f"Razorpay Verification Error: {e}")
         return jsonify({'success': False, 'message': f'Payment verification failed. Please contact support with Payment ID: {payment_id}. Error: {e}'}), 400
 
     # --- Final DB Check (Race Condition) ---
+    # With the Postgres exclusion constraint the INSERT below is the check; otherwise re-check here
     vehicle = Vehicle.query.filter_by(vehicle_id_code=vehicle_id_code).first()
-    if not is_vehicle_available(vehicle.id, start_date_str_iso, end_date_str_iso):
+    if not booking_overlap_enforced and not is_vehicle_available(vehicle.id, start_date_str_iso, end_date_str_iso):
         return jsonify({'success': False, 'message': 'Vehicle was booked by another user during payment. Refund will be processed shortly.'}), 409
 
     # --- Final Price Re-verification ---
-    DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
-    s = datetime.strptime(start_date_str_iso, DATE_FORMAT)
-    e = datetime.strptime(end_date_str_iso, DATE_FORMAT)
+    try:
+        s = parse_booking_datetime(start_date_str_iso)
+        e = parse_booking_datetime(end_date_str_iso)
+    except ValueError:
+        return jsonify({'success': False, 'message': f'Invalid booking dates. Please contact support with Payment ID: {payment_id}.'}), 400
     time_difference = e - s
     total_hours = time_difference.total_seconds() / 3600
     
@@ -2078,23 +3288,35 @@ def confirm_booking():
         
     # --- Save Booking ---
     try:
-        
-        new_booking = Booking(
-            user_id=user_id,
-            vehicle_id=vehicle.id, 
-            start_date=s,
-            end_date=e,
-            total_price=round(server_total), 
-            deposit_amount=server_deposit, # NEW
-            deposit_refund_status='Pending', # NEW: Always Pending initially
-            status='Confirmed', 
-            payment_id=payment_id, 
-            refund_status='NotApplicable' 
-        )
-        db.session.add(new_booking)
+        # Single-row Core INSERT ... RETURNING id: no ORM instance, unit-of-work flush or identity-map entry
+        new_booking_id = db.session.execute(
+            insert(Booking).values(
+                user_id=user_id,
+                vehicle_id=vehicle.id, 
+                start_date=s,
+                end_date=e,
+                total_price=round(server_total), 
+                deposit_amount=server_deposit, # NEW
+                deposit_refund_status='Pending', # NEW: Always Pending initially
+                status='Confirmed', 
+                payment_id=payment_id, 
+                refund_status='NotApplicable',
+                # Receipt figures, so download_receipt doesn't redo the math on every download
+                billed_hours=billed_hours_for(s, e),
+                subtotal_base=round(server_total_subtotal),
+                gst=server_gst
+            ).returning(Booking.id)
+        ).scalar_one()
         db.session.commit()
+        invalidate_inventory_cache()
+        invalidate_admin_stats()
         
-        return jsonify({'success': True, 'message': 'Booking confirmed and paid!', 'booking_id': new_booking.id, 'total': round(server_total)}), 200
+        return jsonify({'success': True, 'message': 'Booking confirmed and paid!', 'booking_id': new_booking_id, 'total': round(server_total)}), 200
+
+    except IntegrityError:
+        # Overlap rejected by the exclusion constraint: another payment confirmed these dates first
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Vehicle was booked by another user during payment. Refund will be processed shortly.'}), 409
 
     except Exception as e:
         db.session.rollback()
@@ -2116,22 +3338,18 @@ def cancel_booking(booking_id):
     if booking.status in ['Cancelled', 'Completed']:
         return jsonify({'success': False, 'message': f"Booking status '{booking.status}' cannot be cancelled."}), 400
 
-    booked_at = booking.booked_at
-    time_difference = datetime.utcnow() - booked_at
-    cancellation_fee = 0
-    
-    if time_difference < timedelta(hours=1):
-        refund_amount = booking.total_price 
-    else:
-        cancellation_fee = round(booking.total_price * 0.10)
-        refund_amount = booking.total_price - cancellation_fee
+    cancellation_fee = cancellation_fee_for(booking.total_price, booking.booked_at, datetime.utcnow())
+    refund_amount = booking.total_price - cancellation_fee
         
     try:
         # Update DB status and set refund_status to Pending
         booking.status = 'Cancelled'
+        booking.cancellation_fee = cancellation_fee # The admin refund queue reads this back
         booking.refund_status = 'Pending' # Mark for Admin review (Full Refund Flow)
         booking.deposit_refund_status = 'NotApplicable' # Deposit refund handled as part of the total refund here
         db.session.commit()
+        invalidate_inventory_cache()
+        invalidate_admin_stats()
 
         flash(f"✅ Booking #{booking_id} has been cancelled. Refund request submitted for ₹{refund_amount}.", 'success')
         return jsonify({
@@ -2154,12 +3372,16 @@ def cancel_booking(booking_id):
 if __name__ == '__main__':
     # When running locally, this block executes, ensuring local SQLite setup and admin creation runs.
     # On Render, the logic in the 'CRITICAL DATABASE INITIALIZATION FIX' block handles setup.
-    with app.app_context():
-        # NOTE: db.create_all() will run again, but SQLAlchemy safely skips creating existing tables.
-        print("Creating all database tables (Local Fallback)...")
-        db.create_all() 
-        
-        print("Creating/Updating Super Admin (Local Fallback)...")
-        create_admin_user("admin@primedrew.com", "9999999999", "adminpass")
+    # The debug reloader re-executes this file in a child process (WERKZEUG_RUN_MAIN=true);
+    # the fallback setup already ran in the parent, so the child skips it
+    if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+        with app.app_context():
+            # NOTE: the startup block above already did this; it only creates tables that are still missing.
+            bootstrap_log.info("Creating all database tables (Local Fallback)...")
+            create_missing_tables()
+            
+            # Startup only seeds an admin when none exists; SEED_ADMIN=1 (or `flask seed-admin`) also resets the default admin's password
+            if os.environ.get('SEED_ADMIN') == '1':
+                seed_default_admin()
             
     app.run(debug=True, port=5000)
\ No newline at end of file
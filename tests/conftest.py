@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from itertools import count
+
+import pytest
+
+# Point the app at a throwaway SQLite file before it is imported (it configures the database at import time)
+_DB_DIR = tempfile.mkdtemp(prefix='primedrew-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_DB_DIR, 'test.db')
+os.environ.pop('REDIS_URL', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as primedrew  # noqa: E402
+
+_ids = count(1)
+
+
+@pytest.fixture
+def app():
+    primedrew.app.config['TESTING'] = True
+    with primedrew.app.app_context():
+        primedrew.db.session.remove()
+        primedrew.db.drop_all()
+        primedrew.db.create_all()
+        yield primedrew.app
+        primedrew.db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def make_user(role='customer', **fields):
+    n = next(_ids)
+    values = dict(primedrew._ADMIN_DEFAULTS)
+    values.update(
+        firebase_uid=f'uid-{n}', phone=f'90000{n:05d}', email=f'user{n}@example.com',
+        password=primedrew.DUMMY_PASSWORD_HASH, role=role, first_name=f'User{n}',
+        is_approved_host=role == 'host', is_active=True,
+    )
+    values.update(fields)
+    user = primedrew.User(**values)
+    primedrew.db.session.add(user)
+    primedrew.db.session.commit()
+    return user
+
+
+def make_vehicle(host, **fields):
+    n = next(_ids)
+    values = dict(
+        host_id=host.id, vehicle_id_code=f'veh-{n}', name=f'Vehicle {n}', brand='Honda', type='Car',
+        fuel='Petrol', gear='Manual', city='Pune', base_price=100.0, image_url='/static/uploads/x.jpg',
+    )
+    values.update(fields)
+    vehicle = primedrew.Vehicle(**values)
+    primedrew.db.session.add(vehicle)
+    primedrew.db.session.commit()
+    return vehicle
+
+
+def make_booking(customer, vehicle, start, end, **fields):
+    values = dict(
+        user_id=customer.id, vehicle_id=vehicle.id, start_date=start, end_date=end,
+        total_price=1000.0, deposit_amount=0.0, status='Confirmed',
+    )
+    values.update(fields)
+    booking = primedrew.Booking(**values)
+    primedrew.db.session.add(booking)
+    primedrew.db.session.commit()
+    return booking
+
+
+def future(days, hour=10):
+    return (datetime.utcnow() + timedelta(days=days)).replace(hour=hour, minute=0, second=0, microsecond=0)
+
+
+def log_in(client, user):
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+        sess['user_id'] = user.id
+        sess['user_role'] = user.role
@@ -0,0 +1,34 @@
+import pytest
+
+import app as primedrew
+from conftest import log_in, make_user, make_vehicle
+
+NAIVE = '2030-01-01 10:00:00'
+AWARE = '2030-01-02T10:00:00+05:30'
+
+
+def test_parse_booking_datetime_accepts_the_booking_shape():
+    assert primedrew.parse_booking_datetime('2030-01-01T10:00:00') == primedrew.parse_booking_datetime(NAIVE)
+
+
+@pytest.mark.parametrize('value', [AWARE, '2030-01-02', '2030-01-02 10:00:00Z', None])
+def test_parse_booking_datetime_rejects_other_shapes(value):
+    with pytest.raises(ValueError):
+        primedrew.parse_booking_datetime(value)
+
+
+def test_mixed_offset_pair_is_not_priced_or_available(app):
+    assert primedrew.price_for_server(100.0, 'Petrol', NAIVE, AWARE) == 0
+    assert primedrew.is_vehicle_available(1, NAIVE, AWARE) is False
+
+
+def test_order_with_mixed_offset_pair_is_rejected(client):
+    customer, vehicle = make_user(), make_vehicle(make_user('host'))
+    log_in(client, customer)
+
+    response = client.post('/api/create_razorpay_order', json={
+        'vehicle_id': vehicle.vehicle_id_code, 'start_date': NAIVE, 'end_date': AWARE,
+    })
+
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
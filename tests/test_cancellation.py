@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+import app as primedrew
+from conftest import future, log_in, make_booking, make_user, make_vehicle
+
+
+def test_admin_refund_queue_shows_the_fee_cancel_booking_charged(client):
+    customer, admin = make_user(), make_user('super_admin')
+    vehicle = make_vehicle(make_user('host'))
+    # 10% of 1005 is exactly 100.5, where half-to-even and half-away-from-zero disagree
+    booking = make_booking(
+        customer, vehicle, future(5), future(6), total_price=1005.0,
+        booked_at=datetime.utcnow() - timedelta(hours=2),
+    )
+
+    log_in(client, customer)
+    fee = client.post(f'/api/cancel_booking/{booking.id}').get_json()['fee']
+    assert primedrew.db.session.get(primedrew.Booking, booking.id).cancellation_fee == fee
+
+    log_in(client, admin)
+    page = client.get('/admin').get_data(as_text=True)
+    assert f'₹{fee}<' in page
+    assert f'₹{1005 - fee}' in page
+
+
+def test_cancellation_within_the_first_hour_is_free():
+    now = datetime.utcnow()
+    assert primedrew.cancellation_fee_for(1005.0, now - timedelta(minutes=59), now) == 0
+    assert primedrew.cancellation_fee_for(1000.0, now - timedelta(hours=1), now) == 100
@@ -0,0 +1,14 @@
+from unittest import mock
+
+import app as primedrew
+
+
+def test_empty_snapshot_is_fresh_after_a_rebuild(app):
+    # No confirmed bookings anywhere: the rebuild writes no snapshot rows
+    assert primedrew.demand_counts_by_type('Pune') == {}
+
+    with mock.patch.object(primedrew, 'refresh_demand_snapshot') as refresh:
+        assert primedrew.demand_counts_by_type('Pune') == {}
+        assert primedrew.demand_counts_by_type('Mumbai') == {}
+
+    refresh.assert_not_called()
@@ -0,0 +1,48 @@
+from conftest import future, make_booking, make_user, make_vehicle
+
+
+def _pages(client, query):
+    """Follows X-Next-After through every page; returns (ids per page)."""
+    pages, after = [], 0
+    while True:
+        response = client.get(f'/api/inventory?{query}&after={after}')
+        assert response.status_code == 200
+        pages.append([item['db_id'] for item in response.get_json()])
+        after = response.headers.get('X-Next-After')
+        if after is None:
+            return pages
+
+
+def test_date_filtered_pages_keep_paginating_past_booked_vehicles(client):
+    host, customer = make_user('host'), make_user()
+    vehicles = [make_vehicle(host) for _ in range(5)]
+    start, end = future(10), future(11)
+    # The whole first page (ids 1-2) and one vehicle on the second page are booked in the window
+    for vehicle in (vehicles[0], vehicles[1], vehicles[3]):
+        make_booking(customer, vehicle, start, end)
+
+    query = f"limit=2&start={start:%Y-%m-%dT%H:%M}&end={end:%Y-%m-%dT%H:%M}"
+    pages = _pages(client, query)
+
+    assert pages == [[], [vehicles[2].id], [vehicles[4].id]]
+
+
+def test_cursor_points_at_last_scanned_vehicle(client):
+    host, customer = make_user('host'), make_user()
+    vehicles = [make_vehicle(host) for _ in range(3)]
+    start, end = future(10), future(11)
+    make_booking(customer, vehicles[1], start, end)
+
+    response = client.get(f"/api/inventory?limit=2&start={start:%Y-%m-%dT%H:%M}&end={end:%Y-%m-%dT%H:%M}")
+
+    assert [item['db_id'] for item in response.get_json()] == [vehicles[0].id]
+    assert response.headers['X-Next-After'] == str(vehicles[1].id)
+
+
+def test_date_filter_rejects_utc_offsets(client):
+    make_vehicle(make_user('host'))
+
+    response = client.get('/api/inventory?start=2030-01-01T10:00&end=2030-01-02T10:00%2B05:30')
+
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
@@ -0,0 +1,33 @@
+import app as primedrew
+from conftest import make_user
+
+
+def test_email_folding_skips_collisions_without_blocking_other_rows(app):
+    first, second, other, taken, clash = (
+        make_user(email=email).id
+        for email in ('Alice@Example.com', 'ALICE@example.com', 'Bob@Example.com', 'carol@example.com', 'Carol@Example.com')
+    )
+    primedrew.db.session.remove()
+
+    primedrew.upgrade_legacy_schema()
+    primedrew.upgrade_legacy_schema()
+
+    emails = {user.id: user.email for user in primedrew.User.query.all()}
+    assert emails[first] == 'alice@example.com'
+    assert emails[second] == 'ALICE@example.com'
+    assert emails[other] == 'bob@example.com'
+    assert emails[taken] == 'carol@example.com'
+    assert emails[clash] == 'Carol@Example.com'
+
+
+def test_create_missing_indexes_only_creates_what_is_missing(app, capsys):
+    with primedrew.db.engine.begin() as conn:
+        conn.execute(primedrew.text('DROP INDEX ix_booking_status_refund'))
+    capsys.readouterr()
+
+    primedrew.create_missing_indexes()
+    primedrew.create_missing_indexes()
+
+    assert capsys.readouterr().out == '✅ Created index ix_booking_status_refund.\n'
+    indexes = primedrew.inspect(primedrew.db.engine).get_indexes('booking')
+    assert 'ix_booking_status_refund' in {index['name'] for index in indexes}